@@ -5,7 +5,7 @@ import sys, os, pprint, traceback, shutil
 print(sys.version)
 
 # import custom modules
-from modules import common_functions, csv2sqlite, determine_project_id, analysis, log, shp2sqlite, to_csv, to_browsers
+from modules import common_functions, csv2sqlite, long_format, determine_project_id, analysis, log, shp2sqlite, to_csv, to_browsers
 
 
 def RAP(configfilepath, initial_msg, custom_datapath = None, ignore_testdata = True):
@@ -13,6 +13,7 @@ def RAP(configfilepath, initial_msg, custom_datapath = None, ignore_testdata = T
 	initial_msg is used when another program such as TDT is run before this script run. The message will be carried on to the log file.
 	custom_datapath is used when TDT did is run right before this tool. custom_datapath will replace config's CSV.folderpath variable.
 	For example, if TDT downloads new set of data at C:\raw_data\RAP_project_2020-07-13_4\data folder, this should be entered as the custom_datapath
+	custom_datapath can also be the zip file itself (eg. C:\raw_data\RAP_project_2020-07-13_4.zip). Then the zip file doesn't need to be extracted.
 	"""
 	timenow = common_functions.datetime_readable() #eg. Apr 21, 2020. 02:09 PM
 
@@ -22,9 +23,13 @@ def RAP(configfilepath, initial_msg, custom_datapath = None, ignore_testdata = T
 
 	# if custom datapath is available, use that instead of the path given in the cfg file.
 	if custom_datapath != None:
-		if os.path.isdir(custom_datapath):
+		if os.path.isdir(custom_datapath) or os.path.isfile(custom_datapath):
 			cfg_dict['INPUT']['inputdatafolderpath'] = custom_datapath
 
+	# the input data can be the zip file downloaded by TDT. The csv files and photos are read straight from the zip file (no extraction needed).
+	if cfg_dict['INPUT']['inputdatafolderpath'].upper().endswith('.ZIP') and os.path.isfile(cfg_dict['INPUT']['inputdatafolderpath']):
+		cfg_dict['INPUT']['inputdatafolderpath'] = common_functions.zip_data_folderpath(cfg_dict['INPUT']['inputdatafolderpath'])
+
 	# start logging
 	logfile = os.path.join(os.path.split(os.path.abspath(__file__))[0], 'log_rap.txt')
 	debug = True if cfg_dict['LOG']['debug'].upper() == 'TRUE' else False
@@ -69,7 +74,20 @@ def RAP(configfilepath, initial_msg, custom_datapath = None, ignore_testdata = T
 
 		# csv2sqlite
 		# creating sqlite database from the csv files
-		c2s = csv2sqlite.Csv2sqlite(cfg_dict['INPUT']['inputdatafolderpath'],db_output_path,cfg_dict['SQLITE']['unique_id_fieldname'],logger, ignore_testdata)
+		c2s = csv2sqlite.Csv2sqlite(cfg_dict['INPUT']['inputdatafolderpath'],db_output_path,cfg_dict['SQLITE']['unique_id_fieldname'],logger, ignore_testdata,
+			batch_size = int(cfg_dict['INGEST']['insert_batch_size']),
+			pragma_profile = eval(cfg_dict['INGEST']['ingest_pragma_profile']),
+			num_workers = int(cfg_dict['INGEST']['ingest_workers']),
+			split_workers = int(cfg_dict['INGEST']['large_csv_workers']),
+			split_min_mb = float(cfg_dict['INGEST']['large_csv_mb']),
+			infer_types = eval(cfg_dict['INGEST']['infer_column_types']),
+			column_types_csv = cfg_dict['INGEST']['column_types_csv'],
+			type_sample_rows = int(cfg_dict['INGEST']['type_sample_rows']),
+			column_manifest_csv = cfg_dict['INGEST']['column_manifest_csv'] if eval(cfg_dict['INGEST']['column_projection']) else None,
+			cache_folderpath = common_functions.get_cache_folderpath(cfg_dict) if eval(cfg_dict['INGEST']['reuse_unchanged_csv']) or eval(cfg_dict['INGEST']['incremental_ingest']) else None,
+			incremental = eval(cfg_dict['INGEST']['incremental_ingest']),
+			record_identity = cfg_dict['INGEST']['record_identity'],
+			record_version_field = cfg_dict['INGEST']['record_version_field'])
 		db_filepath = c2s.db_fullpath_new
 		tablenames_n_rec_count = c2s.tablenames_n_rec_count
 		logger.debug("Checkpoint after csv2sqlite:\ndb_filepath = %s\ntablenames_n_rec_count = %s"%(db_filepath,tablenames_n_rec_count))
@@ -78,6 +96,14 @@ def RAP(configfilepath, initial_msg, custom_datapath = None, ignore_testdata = T
 		### the tables should have all the info of the input csv files (i.e. Clearcut_Survey_v2021, Shelterwood_Survey_v2021)
 
 
+		# long_format
+		# one row per species entry (survey_trees) and one row per plot (survey_plots)
+		if eval(cfg_dict['INGEST']['long_format_tables']):
+			lf = long_format.Long_format(cfg_dict, db_filepath, tablenames_n_rec_count, logger)
+			lf.run_all()
+			tablenames_n_rec_count = lf.tablenames_n_rec_count
+
+
 
 		# shp2sqlite
 		# creating sqlite table from the shp file (project boundaries and info)
@@ -5,23 +5,24 @@ from TDT import executeTDT
 import RAP
 
 
-# running TDT tool
-# if you need to configure TDT tool, then you need to edit TDT/executeTDT.py or TDT/TDT.cfg file.
-tdt_msg = executeTDT.main() #eg. if failed: returns -1, if success: C:\DanielK_Work\OfficeWork\Temp\raw_data\RAP_project_2020-07-13_4.zip
-
-if tdt_msg == -1:
-	custom_datapath = None
-	initial_msg = "TDT failed to download projects from Terraflex inSphere server"
-
-else:
-	custom_datapath = os.path.join(tdt_msg[:-4],'data') # eg. C:\DanielK_Work\OfficeWork\Temp\raw_data\RAP_project_2020-07-13_4\data
-	initial_msg = "TDT download successful!\nDownload path: %s"%custom_datapath
-
-
-# running SEM.py tool
-configfile = r'D:\ACTIVE\HomeOffice\RAP\script\SEM.cfg'
-SEM.sem(configfile,initial_msg,custom_datapath, ignore_testdata = True)
-print('SEM.py run successfully!!')
-time.sleep(10)
-
-
+# everything runs under the __main__ guard. On Windows, the worker processes (ingest_workers, large_csv_workers, geo_workers in RAP.cfg)
+# start by importing this script again, and without the guard each of them would run TDT and the whole RAP program again.
+if __name__ == '__main__':
+	# running TDT tool
+	# if you need to configure TDT tool, then you need to edit TDT/executeTDT.py or TDT/TDT.cfg file.
+	tdt_msg = executeTDT.main() #eg. if failed: returns -1, if success: C:\DanielK_Work\OfficeWork\Temp\raw_data\RAP_project_2020-07-13_4.zip
+
+	if tdt_msg == -1:
+		custom_datapath = None
+		initial_msg = "TDT failed to download projects from Terraflex inSphere server"
+
+	else:
+		custom_datapath = tdt_msg # the csv files and photos are read straight from the zip file. eg. C:\DanielK_Work\OfficeWork\Temp\raw_data\RAP_project_2020-07-13_4.zip
+		initial_msg = "TDT download successful!\nDownload path: %s"%custom_datapath
+
+
+	# running SEM.py tool
+	configfile = r'D:\ACTIVE\HomeOffice\RAP\script\SEM.cfg'
+	SEM.sem(configfile,initial_msg,custom_datapath, ignore_testdata = True)
+	print('SEM.py run successfully!!')
+	time.sleep(10)
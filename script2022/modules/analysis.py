@@ -29,6 +29,7 @@ class Run_analysis:
 		self.db_filepath = db_filepath
 		self.prj_shp_tbl_name = cfg_dict['SHP']['shp2sqlite_tablename'] # the name of the existing sqlite table that is a copy of project boundary shpfile.
 		self.prj_shp_prjid_fieldname = cfg_dict['SHP']['project_id_fieldname'].upper()
+		self.prj_shp_geom_fieldname = cfg_dict['SHP']['shp2sqlite_geom_fieldname']
 		# self.prj_shp_area_ha_fieldname = cfg_dict['SHP']['area_ha_fieldname'].upper()
 		# self.prj_shp_dist_fieldname = cfg_dict['SHP']['dist_fieldname'].upper()
 		# self.prj_shp_fmu_fieldname = cfg_dict['SHP']['fmu_fieldname'].upper()
@@ -63,6 +64,9 @@ class Run_analysis:
 		self.cc_cluster_in_dict = common_functions.sqlite_2_dict(self.db_filepath, self.clearcut_tbl_name) # clearcut_survey table in the sqlite to a list of dictionary
 		self.sh_cluster_in_dict = common_functions.sqlite_2_dict(self.db_filepath, self.shelterwood_tbl_name) # shelterwood_survey table in the sqlite to a list of dictionary
 		self.prj_shp_in_dict = common_functions.sqlite_2_dict(self.db_filepath, self.prj_shp_tbl_name) # projects_shp table in the sqlite to a list of dictionary
+		# the polygons (WKB) are not needed here
+		for prj in self.prj_shp_in_dict:
+			prj.pop(self.prj_shp_geom_fieldname, None)
 
 		if len(self.cc_cluster_in_dict) > 1:
 			self.logger.debug("Printing the first SURVEYED clearcut record (total %s records):\n%s\n"%(len(self.cc_cluster_in_dict),self.cc_cluster_in_dict[0]))
@@ -281,8 +285,8 @@ class Run_analysis:
 									continue # move on to the next species
 
 								# below will run only if we have a species code such as "Bf"
-								spc_count_raw = cluster['Species'+str(spc_num)+'NumberofTreesPlot'+plotnum] # eg. '2' or ''
-								if spc_count_raw in ['0', '', None]:
+								spc_count_raw = cluster['Species'+str(spc_num)+'NumberofTreesPlot'+plotnum] # eg. '2' or '' (or 2 if the column is typed INTEGER)
+								if spc_count_raw in [0, '0', '', None]:
 									continue # move on to the next species
 								else:
 									spc_count = int(spc_count_raw)
@@ -315,8 +319,8 @@ class Run_analysis:
 									continue # move on to the next species
 
 								# below will run only if we have a species code such as "Bf"
-								spc_count_raw = cluster['Species'+str(spc_num)+'NumberofTreesPlot'+plotnum] # eg. '2' or ''
-								if spc_count_raw in ['0', '', None]:
+								spc_count_raw = cluster['Species'+str(spc_num)+'NumberofTreesPlot'+plotnum] # eg. '2' or '' (or 2 if the column is typed INTEGER)
+								if spc_count_raw in [0, '0', '', None]:
 									continue # move on to the next species
 								else:
 									spc_count = int(spc_count_raw)
@@ -493,6 +497,8 @@ class Run_analysis:
 		self.logger.info("Running photo_alternate_paths method")
 		# we will ultimately alter the self.clus_summary_dict_lst. first, we make a copy of it to loop it and change it as we go.
 		temp_clus_summary_dict_lst = self.clus_summary_dict_lst.copy()
+		# if the photos are in the TDT zip file, the zip file is opened once and used for all the photos (see common_functions.copy_input_file)
+		open_zips = {}
 
 		
 		# loop through the cluster summary records (each record is a dictionary)
@@ -535,7 +541,7 @@ class Run_analysis:
 						if not os.path.exists(new_local_fullpath):
 							self.logger.info("Copying photo: %s"%new_filename)
 							print("Copying photo: %s"%new_filename)
-							shutil.copy2(original_fullpath, new_local_fullpath)
+							common_functions.copy_input_file(original_fullpath, new_local_fullpath, open_zips) # the original can be inside the TDT zip file
 
 						# write the new paths down to the summary dictionary
 						c_local_sync_photopath[location_taken].append(new_local_fullpath) 
@@ -544,6 +550,8 @@ class Run_analysis:
 			self.clus_summary_dict_lst[index][self.c_local_sync_photopath] = c_local_sync_photopath
 			self.clus_summary_dict_lst[index][self.c_sharepoint_photopath] = c_sharepoint_photopath
 
+		common_functions.close_input_zips(open_zips)
+
 		# for i in range(len(self.clus_summary_dict_lst)):
 		# 	self.logger.info(str(self.clus_summary_dict_lst[i][self.c_local_sync_photopath]))
 		# 	self.logger.info(str(self.clus_summary_dict_lst[i][self.c_sharepoint_photopath]))
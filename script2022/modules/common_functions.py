@@ -112,6 +112,30 @@ def sqlite_2_dict(sqlite_db_file, tablename):
 	
 	return result
 
+def sqlite_extra_2_dict(sqlite_db_file, tablename, unique_id_fieldname = 'unique_id', unique_ids = None):
+	"""
+	reads back the columns that the column projection left out of a survey table (see csv2sqlite.csv_to_table).
+	tablename is the survey table (eg. 'Clearcut_Survey_v2022'), not the _extra table.
+	if unique_ids is given (eg. [1, 5, 12]), only those records are read.
+	returns {unique_id: {fieldname: value}} eg. {1: {'hae': '201.3', 'CollectedBy': 'kimdan'}, 2: {...},...}
+	"""
+	import sqlite3, json, zlib
+
+	con = sqlite3.connect(sqlite_db_file)
+	c = con.cursor()
+	if c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (tablename + '_extra',)).fetchone()[0] == 0:
+		con.close()
+		return {}
+	if unique_ids == None:
+		c.execute('SELECT %s, data FROM %s_extra'%(unique_id_fieldname, tablename))
+	else:
+		c.execute('SELECT %s, data FROM %s_extra WHERE %s IN (%s)'%(unique_id_fieldname, tablename, unique_id_fieldname, ','.join(['?']*len(unique_ids))), list(unique_ids))
+
+	result = {row[0]: json.loads(zlib.decompress(row[1]).decode()) for row in c.fetchall()}
+	con.close()
+
+	return result
+
 def create_proj_tbl_name(proj_id, prefix = 'z_'):
 	"""input the project id and it will output a project table name
 	special characters will be replaced by "_" and it will have a prefix of z_.
@@ -309,6 +333,139 @@ def replace_txt_in_file(txtfile, being_replaced, replacing_with):
 		f.write(html_script)
 
 
+def file_fingerprint(filepath, old_fingerprint = None):
+	"""
+	returns [size, mtime, sha256] of a file. eg. [1520384, 1657812345.123, 'e3b0c442...']
+	if old_fingerprint is given and the file still has the same size and modified time,
+	the old hash is used again instead of reading the whole file.
+	the file can be inside a zip file (see split_zip_path).
+	"""
+	import os, hashlib, time, zipfile
+	zip_path, member = split_zip_path(filepath)
+	if zip_path != None:
+		# a file inside a zip file already has a content hash (crc32) in the zip file, so there's no need to read it.
+		with zipfile.ZipFile(zip_path) as z:
+			info = z.getinfo(member)
+		return [info.file_size, time.mktime(info.date_time + (0, 0, -1)), 'crc32:%08x'%info.CRC]
+
+	stat = os.stat(filepath)
+	size, mtime = stat.st_size, stat.st_mtime
+	if old_fingerprint != None and old_fingerprint[0] == size and old_fingerprint[1] == mtime:
+		return [size, mtime, old_fingerprint[2]]
+
+	sha = hashlib.sha256()
+	with open(filepath, 'rb') as f:
+		for block in iter(lambda: f.read(1024*1024), b''):
+			sha.update(block)
+	return [size, mtime, sha.hexdigest()]
+
+
+def split_zip_path(path):
+	"""
+	a file inside a zip file (eg. the TDT download) is written as if the zip file were a folder.
+	eg. C:\\raw_data\\RAP_project_2022-07-13_4.zip\\data\\Clearcut_Survey_v2022.csv
+	returns [zip file path, member name] eg. ['C:\\raw_data\\RAP_project_2022-07-13_4.zip', 'data/Clearcut_Survey_v2022.csv']
+	or [None, path] if the path is not inside a zip file.
+	"""
+	import os, re
+	match = re.match(r'^(.*?\.zip)(?:[\\/](.*))?$', path, re.IGNORECASE)
+	if match and os.path.isfile(match.group(1)):
+		member = (match.group(2) or '').replace('\\', '/').strip('/')
+		return [match.group(1), member]
+	return [None, path]
+
+
+def zip_data_folderpath(zip_path):
+	"""
+	finds the folder inside the zip file that has the csv files (the shallowest one).
+	eg. C:\\raw_data\\RAP_project_2022-07-13_4.zip -> C:\\raw_data\\RAP_project_2022-07-13_4.zip\\data
+	"""
+	import os, zipfile
+	with zipfile.ZipFile(zip_path) as z:
+		csv_folders = [os.path.dirname(name) for name in z.namelist() if name.upper().endswith('.CSV')]
+	if len(csv_folders) == 0:
+		return zip_path
+	csv_folder = sorted(csv_folders, key = lambda folder: (folder.count('/'), folder))[0] # eg. 'data'
+	return os.path.join(zip_path, *csv_folder.split('/')) if csv_folder != '' else zip_path
+
+
+def list_input_files(folderpath):
+	"""
+	same as os.listdir, but the folder can be inside a zip file (see split_zip_path). only the files are listed.
+	"""
+	import os, zipfile
+	zip_path, member = split_zip_path(folderpath)
+	if zip_path == None:
+		return [file for file in os.listdir(folderpath) if os.path.isfile(os.path.join(folderpath, file))]
+	prefix = member + '/' if member != '' else ''
+	with zipfile.ZipFile(zip_path) as z:
+		names = z.namelist()
+	return [name[len(prefix):] for name in names if name.startswith(prefix) and '/' not in name[len(prefix):] and not name.endswith('/')]
+
+
+def open_input_file(filepath, encoding = 'utf-8-sig'):
+	"""
+	opens a text file for reading. The file can be inside a zip file, in which case it's streamed out of the zip file without extracting it.
+	"""
+	import io, zipfile
+	zip_path, member = split_zip_path(filepath)
+	if zip_path == None:
+		return open(filepath, encoding = encoding)
+	with zipfile.ZipFile(zip_path) as z:
+		member_file = z.open(member) # the member stays readable after the ZipFile object is closed
+	return io.TextIOWrapper(member_file, encoding = encoding)
+
+
+def copy_input_file(src, dst, open_zips = None):
+	"""
+	same as shutil.copy2, but src can be inside a zip file (eg. a photo in the TDT download).
+	the photo is copied straight out of the zip file with its modified time.
+	open_zips is a dictionary the caller keeps between calls, eg. {'C:\\raw_data\\RAP_project.zip': <ZipFile>}.
+	the zip file is opened (and its list of members read) only once, the first time it's needed, and stays open in open_zips.
+	the caller closes them when it's done copying (see close_input_zips). if open_zips is None, the zip file is opened and closed for this file only.
+	"""
+	import os, time, shutil, zipfile
+	zip_path, member = split_zip_path(src)
+	if zip_path == None:
+		shutil.copy2(src, dst)
+		return
+	if open_zips == None:
+		with zipfile.ZipFile(zip_path) as z:
+			copy_input_file(src, dst, {zip_path: z})
+		return
+	if zip_path not in open_zips:
+		open_zips[zip_path] = zipfile.ZipFile(zip_path)
+	z = open_zips[zip_path]
+	mtime = time.mktime(z.getinfo(member).date_time + (0, 0, -1))
+	with z.open(member) as src_file, open(dst, 'wb') as dst_file:
+		shutil.copyfileobj(src_file, dst_file, 1024*1024)
+	os.utime(dst, (mtime, mtime))
+
+
+def close_input_zips(open_zips):
+	"""
+	closes the zip files opened by copy_input_file.
+	"""
+	for z in open_zips.values():
+		z.close()
+	open_zips.clear()
+
+
+def get_cache_folderpath(cfg_dict):
+	"""
+	returns the folder where the ingest caches are kept (creates it if it doesn't exist).
+	the output folder is deleted at the start of every run, so by default the cache folder sits next to it.
+	eg. C:\\RAP_Outputs\\2023run -> C:\\RAP_Outputs\\2023run_cache
+	"""
+	import os
+	cache_folderpath = cfg_dict['INGEST']['cache_folderpath'].strip()
+	if cache_folderpath == '':
+		cache_folderpath = cfg_dict['OUTPUT']['outputfolderpath'].rstrip('\\/') + '_cache'
+	if not os.path.exists(cache_folderpath):
+		os.makedirs(cache_folderpath)
+	return cache_folderpath
+
+
 if __name__ == '__main__':
 	# print(datetime_stamp())
 	print(datetime_readable())
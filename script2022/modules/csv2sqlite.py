@@ -1,4 +1,4 @@
-import os, csv, sqlite3
+import os, io, re, csv, json, zlib, mmap, math, fnmatch, itertools, collections, sqlite3, time, shutil, multiprocessing
 
 # importing custom modules
 if __name__ == '__main__':
@@ -6,12 +6,601 @@ if __name__ == '__main__':
 else:
 	from modules import common_functions
 
+# pragma profile used while the csv files are being loaded (only if ingest_pragma_profile = True in the config file).
+# journal in memory and no fsync - if the computer crashes in the middle of the ingest, the database is lost,
+# but the database is re-created from the csv files on every run anyway.
+# cache_size is negative, which means KiB (i.e. -20000 = about 20MB of page cache). This is the memory ceiling of sqlite.
+INGEST_PRAGMAS = [['journal_mode', 'MEMORY'], ['synchronous', 'OFF'], ['cache_size', -20000], ['temp_store', 'MEMORY']]
+
+# sqlite's own default settings. These are put back once the ingest is done, before the other modules use the database.
+SAFE_PRAGMAS = [['journal_mode', 'DELETE'], ['synchronous', 'FULL'], ['cache_size', -2000], ['temp_store', 'DEFAULT']]
+
+
+
+def open_column_types_csv(column_types_csv):
+	"""
+	reads ColumnTypes.csv (see ColumnTypes_how2.txt).
+	returns a list of [column name pattern, type] eg. [['ClusterNumber', 'TEXT'], ['Species*NumberofTrees*', 'INTEGER'],...]
+	"""
+	column_types = []
+	with open(column_types_csv, newline='') as csvfile:
+		reader = csv.reader(csvfile)
+		attributes = next(reader) # the first line
+		for row in reader:
+			if len(row) < 2 or row[0].strip() == '':
+				continue
+			col_type = row[1].strip().upper()
+			if col_type not in ['INTEGER', 'REAL', 'TEXT']:
+				raise Exception('Error in %s. "%s" is not an acceptable type for %s (use INTEGER, REAL or TEXT).'%(column_types_csv, row[1], row[0]))
+			column_types.append([row[0].strip(), col_type])
+	return column_types
+
+
+
+def open_column_manifest_csv(column_manifest_csv):
+	"""
+	reads ColumnManifest.csv (see ColumnManifest_how2.txt).
+	returns a list of column name patterns eg. ['ClusterNumber', 'ProjectID', 'Species*SpeciesNamePlot*',...]
+	"""
+	keep_columns = []
+	with open(column_manifest_csv, newline='') as csvfile:
+		reader = csv.reader(csvfile)
+		attributes = next(reader) # the first line
+		for row in reader:
+			if len(row) < 1 or row[0].strip() == '':
+				continue
+			keep_columns.append(row[0].strip())
+	return keep_columns
+
+
+
+INTEGER_PATTERN = re.compile(r'^-?(0|[1-9][0-9]*)$') # leading zeros (eg. cluster number '0101') are not integers. they'd be lost.
+REAL_PATTERN = re.compile(r'^-?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$')
+
+def to_affinity(value, col_type):
+	"""
+	converts a csv value the way sqlite would store it in a column of col_type (type affinity). eg. '3' in an INTEGER column -> 3
+	used for the values saved in the _extra table, so they come back the same as if they were real columns.
+	"""
+	if col_type in ['INTEGER', 'REAL'] and isinstance(value, str):
+		if INTEGER_PATTERN.match(value):
+			return int(value) if col_type == 'INTEGER' else float(value)
+		if REAL_PATTERN.match(value):
+			number = float(value)
+			return int(number) if col_type == 'INTEGER' and number.is_integer() else number
+	elif col_type == 'REAL' and isinstance(value, int):
+		return float(value)
+	elif col_type == 'TEXT' and isinstance(value, (int, float)):
+		return str(value)
+	return value
+
+
+
+def infer_column_types(fieldnames, sample_rows, column_types):
+	"""
+	decides the type (INTEGER, REAL or TEXT) of each column.
+	if the fieldname matches one of the patterns in column_types (from ColumnTypes.csv), that type is used.
+	otherwise the type is guessed from the values in sample_rows (blank values are ignored):
+		all values are integers -> INTEGER
+		all values are numbers -> REAL
+		anything else, or no values at all -> TEXT
+	returns a list of types in the same order as fieldnames eg. ['TEXT', 'TEXT', 'INTEGER', 'REAL',...]
+	"""
+	types = []
+	for index, fieldname in enumerate(fieldnames):
+		col_type = None
+		for pattern, pattern_type in column_types:
+			if fnmatch.fnmatchcase(fieldname, pattern):
+				col_type = pattern_type
+				break
+
+		if col_type == None:
+			values = [row[index] for row in sample_rows if index < len(row) and row[index] != '']
+			if len(values) == 0:
+				col_type = 'TEXT'
+			elif all(INTEGER_PATTERN.match(v) for v in values):
+				col_type = 'INTEGER'
+			elif all(REAL_PATTERN.match(v) for v in values):
+				col_type = 'REAL'
+			else:
+				col_type = 'TEXT'
+		types.append(col_type)
+	return types
+
+
+
+def read_csv_chunks(reader, num_of_fields, chunk_size, counters, testdata_index = None):
+	"""
+	generator that reads the csv reader chunk_size rows at a time and yields a list of rows for each chunk.
+	only one chunk is held in memory at a time.
+	rows with more values than fieldnames are skipped and counted in counters['err'].
+	rows with less values than fieldnames are filled out with 0.
+	if testdata_index is given, rows with 'Yes' in that column (TestData) are skipped and counted in counters['test'],
+	so the test data never gets written to the database.
+	"""
+	chunk = []
+	for row in reader:
+		# check if number of fieldnames matches with number of values to be inserted
+		# for terraflex projects, this is most likely because lat lon values are missing.
+		if num_of_fields < len(row):
+			# this is usually the case where the FIELDNAME "latitude" or "longitude" is missing
+			counters['err'] += 1
+			continue
+
+		if num_of_fields > len(row):
+			# this is usually the case where the VALUE of "latitude" or "longitude" is missing
+			# This can be resolved by putting 0 in the place of those missing values.
+			difference = num_of_fields - len(row)
+			blank_fill = [0 for i in range(difference)]  # [0, 0, 0] if 3 values are missing.
+			row = row + blank_fill
+
+		if testdata_index != None and row[testdata_index] == 'Yes':
+			counters['test'] += 1
+			continue
+
+		chunk.append(row)
+		if len(chunk) >= chunk_size:
+			yield chunk
+			chunk = []
+
+	# whatever is left over
+	if len(chunk) > 0:
+		yield chunk
+
+
+
+def find_record_boundaries(csv_fullpath, num_of_ranges):
+	"""
+	splits the csv file into num_of_ranges byte ranges that start and end at the end of a record (row).
+	A newline inside a quoted field (eg. multi-line comments) is not the end of a record,
+	so we keep track of whether we are inside a quoted field by counting the double quotes.
+	(escaped quotes come in pairs "", so they don't change the count)
+	returns a list of byte offsets eg. [2048, 10553210, 21106432, 31659648, 42212864]
+	the first offset is the end of the header row and the last one is the size of the file.
+	"""
+	file_size = os.path.getsize(csv_fullpath)
+	targets = [file_size*i//num_of_ranges for i in range(num_of_ranges)] # eg. [0, 10553216, 21106432, 31659648]
+	boundaries = []
+	with open(csv_fullpath, 'rb') as f:
+		mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		pos = 0 # we know whether we are in a quoted field or not up to this position
+		in_quotes = False
+		for target in targets:
+			if target < pos:
+				continue # the previous record ran past this target
+			# count the quotes up to the target, a few MB at a time
+			while pos < target:
+				step = min(target, pos + 8*1024*1024)
+				if mm[pos:step].count(b'"') % 2 == 1:
+					in_quotes = not in_quotes
+				pos = step
+			# move forward to the end of the record
+			while True:
+				newline = mm.find(b'\n', pos)
+				if newline == -1:
+					pos = file_size
+					break
+				quote = mm.find(b'"', pos, newline)
+				if quote == -1:
+					pos = newline + 1
+					if not in_quotes:
+						break
+				else:
+					in_quotes = not in_quotes
+					pos = quote + 1
+			if pos < file_size and pos not in boundaries:
+				boundaries.append(pos)
+		mm.close()
+	boundaries.append(file_size)
+	return boundaries
+
+
+
+def parse_byte_range(args):
+	"""
+	runs in its own process (see read_csv_chunks_parallel).
+	parses the rows between the start and the end byte of the csv file.
+	the rows are cleaned up the same way as read_csv_chunks.
+	returns [rows, number of rows skipped, number of test data rows skipped]
+	"""
+	csv_fullpath, start, end, num_of_fields, testdata_index = args
+	with open(csv_fullpath, 'rb') as f:
+		f.seek(start)
+		text = f.read(end - start).decode('utf-8')
+	# newline = None translates \r\n into \n the same way open() does in csv_to_table
+	reader = csv.reader(io.StringIO(text, newline = None))
+	counters = {'err': 0, 'test': 0}
+	rows = []
+	for chunk in read_csv_chunks(reader, num_of_fields, 100000, counters, testdata_index):
+		rows.extend(chunk)
+	return [rows, counters['err'], counters['test']]
+
+
+
+def read_csv_chunks_parallel(csv_fullpath, num_of_fields, chunk_size, counters, testdata_index, num_workers, logger, range_mb = 16):
+	"""
+	same as read_csv_chunks, but the csv file is split into byte ranges (see find_record_boundaries) 
+	and each byte range is parsed by a worker process.
+	The parsed ranges come back in the same order as the file, so the unique_id values are the same as the serial path.
+	The byte ranges are no bigger than about range_mb and only 2 ranges per worker are sent out at a time -
+	the next range is sent only when the oldest one has been written, so the memory use doesn't grow with the size of the file.
+	"""
+	num_of_ranges = max(num_workers*4, math.ceil(os.path.getsize(csv_fullpath) / (range_mb*1024*1024)))
+	boundaries = find_record_boundaries(csv_fullpath, num_of_ranges)
+	jobs = [[csv_fullpath, boundaries[i], boundaries[i+1], num_of_fields, testdata_index] for i in range(len(boundaries)-1)]
+	logger.info("Parsing %s byte ranges of %s using %s worker processes"%(len(jobs), os.path.basename(csv_fullpath), num_workers))
+	max_in_flight = num_workers*2
+	with multiprocessing.Pool(num_workers) as pool:
+		in_flight = collections.deque() # results of the ranges sent out, oldest first
+		next_job = 0
+		while next_job < len(jobs) or len(in_flight) > 0:
+			while next_job < len(jobs) and len(in_flight) < max_in_flight:
+				in_flight.append(pool.apply_async(parse_byte_range, (jobs[next_job],)))
+				next_job += 1
+			rows, err, test = in_flight.popleft().get()
+			counters['err'] += err
+			counters['test'] += test
+			for i in range(0, len(rows), chunk_size):
+				yield rows[i:i+chunk_size]
+			del rows
+
+
+
+def apply_pragmas(cur, pragmas, profile_name, logger):
+	"""
+	runs PRAGMA statements. pragmas is a list of [pragma, value] eg. [['journal_mode', 'MEMORY'], ['synchronous', 'OFF'],...]
+	"""
+	for pragma, value in pragmas:
+		cur.execute("PRAGMA %s = %s"%(pragma, value))
+	current = {pragma: cur.execute("PRAGMA %s"%pragma).fetchone()[0] for pragma, value in pragmas}
+	logger.info("Applied %s pragma profile: %s"%(profile_name, current))
+
+
+
+def csv_table_name(csv_fullpath):
+	"""
+	table name is bascially the csv file name. eg. Clearcut_Survey_v2022.csv -> Clearcut_Survey_v2022
+	"""
+	table_name = os.path.split(csv_fullpath)[1]
+	table_name = table_name[:-4] # remove '.csv'
+	table_name = common_functions.no_special_char(table_name)
+	return table_name
+
+
+
+def copy_table(cur, table_name, from_db, to_db, with_extra = True):
+	"""
+	copies a table (same columns, types and unique_id values) from one attached database to another. eg. from_db = 'staging', to_db = 'main'
+	if the table already exists in to_db, it is dropped first.
+	if with_extra is True, the side table of the columns left out by the column projection (eg. Clearcut_Survey_v2022_extra) goes with it.
+	the caller takes care of ATTACH and BEGIN/COMMIT.
+	"""
+	if with_extra:
+		extra_table = table_name + '_extra'
+		if cur.execute("SELECT COUNT(*) FROM %s.sqlite_master WHERE type = 'table' AND name = ?"%from_db, (extra_table,)).fetchone()[0] > 0:
+			copy_table(cur, extra_table, from_db, to_db, with_extra = False)
+		else:
+			cur.execute("DROP TABLE IF EXISTS %s.%s"%(to_db, extra_table))
+
+	create_t_sql = cur.execute("SELECT sql FROM %s.sqlite_master WHERE type = 'table' AND name = ?"%from_db, (table_name,)).fetchone()[0]
+	# sqlite keeps the sql without the database name (eg. 'CREATE TABLE Clearcut_Survey_v2022 (...'), so put to_db in front of the table name
+	create_t_sql = create_t_sql.replace('CREATE TABLE ', 'CREATE TABLE %s.'%to_db, 1)
+	cur.execute("DROP TABLE IF EXISTS %s.%s"%(to_db, table_name))
+	cur.execute(create_t_sql)
+	cur.execute("INSERT INTO %s.%s SELECT * FROM %s.%s"%(to_db, table_name, from_db, table_name))
+
+
+
+def csv_to_table(cur, csv_fullpath, unique_id_fieldname, ignore_testdata, batch_size, logger, split_workers = 1, split_min_bytes = 0,
+	column_types = None, type_sample_rows = 1000, table_name = None, keep_columns = None):
+	"""
+	Reads one csv file and writes it into a new table.
+	The csv file is read in chunks of batch_size rows and each chunk is written before reading the next one,
+	so the memory use stays the same no matter how big the csv file is.
+	if split_workers > 1 and the csv file is at least split_min_bytes, the file is parsed by split_workers processes (see read_csv_chunks_parallel).
+	if column_types is a list (see open_column_types_csv), the columns get INTEGER, REAL or TEXT types (see infer_column_types),
+	and sqlite stores the numbers as numbers instead of text. Otherwise the columns have no type, like before.
+	table_name is the csv file name unless given.
+	if keep_columns is a list (see open_column_manifest_csv), only the matching columns become real columns of the table.
+	the rest of each row is saved as a compressed json in the table_name + '_extra' table (unique_id, data). see common_functions.sqlite_extra_2_dict
+	returns [table_name, fieldnames, row_counter]
+	"""
+	csvfile = common_functions.open_input_file(csv_fullpath, encoding='utf-8-sig') # this encoding is necessary to remove BOM from the beginning of CSV. the csv file can be inside a zip file.
+	reader = csv.reader(csvfile)
+	fieldnames = next(reader) # a list of field names.
+
+	if table_name == None:
+		table_name = csv_table_name(csv_fullpath)
+	logger.info("working on '%s'"%table_name)
+
+	# decide the column types from the first few rows.
+	# the sample rows are put back in front of the reader so they get inserted like any other row.
+	if column_types != None:
+		sample_rows = list(itertools.islice(reader, type_sample_rows))
+		reader = itertools.chain(sample_rows, reader)
+		types = infer_column_types(fieldnames, sample_rows, column_types)
+		logger.debug("Column types of %s: %s"%(table_name, dict(zip(fieldnames, types))))
+	else:
+		types = ['' for f in fieldnames]
+
+	# column projection. csv_fieldnames is every column in the csv, fieldnames is only the ones that will be in the table.
+	csv_fieldnames = fieldnames
+	kept_index = list(range(len(csv_fieldnames)))
+	extra_index = []
+	if keep_columns != None:
+		kept_index = [i for i, f in enumerate(csv_fieldnames) if len([pattern for pattern in keep_columns if fnmatch.fnmatchcase(f, pattern)]) > 0]
+		extra_index = [i for i in range(len(csv_fieldnames)) if i not in kept_index]
+		fieldnames = [csv_fieldnames[i] for i in kept_index]
+		extra_types = [types[i] for i in extra_index]
+		types = [types[i] for i in kept_index]
+		logger.debug("%s columns of %s go to %s_extra: %s"%(len(extra_index), table_name, table_name, [csv_fieldnames[i] for i in extra_index]))
+	extra_table = table_name + '_extra'
+	extra_fieldnames = [csv_fieldnames[i] for i in extra_index]
+
+	# the sql script for creating a new table
+	create_t_sql = "CREATE TABLE %s "%table_name
+	str_fieldnames = '('
+	str_fielddefs = '('
+	for f, t in zip(fieldnames, types):
+		str_fieldnames += f + ','
+		str_fielddefs += (f + ' ' + t).strip() + ','  # eg. 'Species1NumberofTreesPlot1 INTEGER,'
+	str_fieldnames = str_fieldnames[:-1] # to remove the trailing comma
+	str_fielddefs = str_fielddefs[:-1]
+
+	str_fieldnames += ")"
+	str_fielddefs += ")"
+
+	# we are going to sneak in a unique_id field that auto-increments as we add data.
+	create_t_sql += str_fielddefs[0] + '%s integer primary key autoincrement, '%unique_id_fieldname + str_fielddefs[1:] + ";"
+
+
+	# creating the table
+	try:
+		logger.debug("Creating a new table: %s"%table_name)
+		# print(create_t_sql)
+		cur.execute(create_t_sql)
+	except:
+		logger.info("* WARNING: Table '%s' already exists. Dropping and recreating the table."%table_name)
+		cur.execute("DROP TABLE %s"%table_name)	
+		cur.execute(create_t_sql)
+	cur.execute("DROP TABLE IF EXISTS %s"%extra_table)
+	if len(extra_index) > 0:
+		cur.execute("CREATE TABLE %s (%s integer primary key, data BLOB)"%(extra_table, unique_id_fieldname))
+
+
+	# inserting values
+	# the values are passed as parameters (?) instead of being written into the sql string,
+	# so quotes and apostrophes in the comments can't break the INSERT statement.
+	logger.debug("running INSERT statement...")
+	insert_sql = "INSERT INTO %s %s VALUES (%s)"%(table_name, str_fieldnames, ','.join(['?']*len(fieldnames)))
+	if len(extra_index) > 0:
+		# the unique_id values are given here (instead of being auto-incremented) so the main table and the _extra table match.
+		insert_sql = "INSERT INTO %s (%s, %s VALUES (?,%s)"%(table_name, unique_id_fieldname, str_fieldnames[1:], ','.join(['?']*len(fieldnames)))
+		insert_extra_sql = "INSERT INTO %s VALUES (?,?)"%extra_table
+	row_counter = 0
+	counters = {'err': 0, 'test': 0}
+
+	# test data is dropped while reading the csv (it never gets inserted)
+	testdata_index = None
+	if ignore_testdata == True:
+		if 'TestData' in csv_fieldnames:
+			testdata_index = csv_fieldnames.index('TestData')
+		else:
+			logger.info("* WARNING: %s does not have TestData field. No test data records will be removed."%table_name)
+
+	start_time = time.time()
+	# a csv file inside a zip file can't be split into byte ranges (see find_record_boundaries)
+	if split_workers > 1 and common_functions.split_zip_path(csv_fullpath)[0] == None and os.path.getsize(csv_fullpath) >= split_min_bytes:
+		chunks = read_csv_chunks_parallel(csv_fullpath, len(csv_fieldnames), batch_size, counters, testdata_index, split_workers, logger)
+	else:
+		chunks = read_csv_chunks(reader, len(csv_fieldnames), batch_size, counters, testdata_index)
+	cur.execute("BEGIN")
+	for chunk in chunks:
+		if len(extra_index) > 0:
+			uids = range(row_counter + 1, row_counter + len(chunk) + 1)
+			cur.executemany(insert_sql, [[uid] + [row[i] for i in kept_index] for uid, row in zip(uids, chunk)])
+			extra_rows = [[uid, {f: to_affinity(row[i], t) for f, i, t in zip(extra_fieldnames, extra_index, extra_types)}] for uid, row in zip(uids, chunk)]
+			cur.executemany(insert_extra_sql, [[uid, zlib.compress(json.dumps(extra).encode())] for uid, extra in extra_rows])
+		else:
+			cur.executemany(insert_sql, chunk)
+		row_counter += len(chunk)
+	err_counter = counters['err']
+
+	# the table is new and unique_id counts up from 1, so the largest unique_id (a quick lookup) should be the number of rows we counted.
+	# if it isn't, count the rows in the table with COUNT(*) and use that instead.
+	max_uid = cur.execute("SELECT IFNULL(MAX(%s), 0) FROM %s"%(unique_id_fieldname, table_name)).fetchone()[0]
+	if max_uid != row_counter:
+		table_count = cur.execute("SELECT COUNT(*) FROM %s"%table_name).fetchone()[0]
+		logger.info("* WARNING: %s rows were counted while loading %s but the largest %s is %s. COUNT(*) = %s"%(row_counter, table_name, unique_id_fieldname, max_uid, table_count))
+		row_counter = table_count
+
+	elapsed = time.time() - start_time
+	rows_per_sec = row_counter/elapsed if elapsed > 0 else row_counter
+	logger.info("Inserted %s rows into '%s' in %.2f seconds (%.0f rows/sec, batch size = %s)"%(row_counter, table_name, elapsed, rows_per_sec, batch_size))
+
+	if err_counter > 0:
+		logger.info("* WARNING: Some fieldnames (such as lat long) seems to be missing in table %s. This can be caused by \
+			the most recently added project or cluster survey not having gps coordinates collected."%table_name)
+
+	# check if fieldnames include latitude and longitude
+	# starting Dec 2020, there are not latitude and longitude field in terraflex connect,
+	# 	instead, they have X, and Y fields. So we need to manually create latitude and longitude fields.
+	# this is done by renaming attribute names. X = longitude, Y = latitude
+	if 'longitude' not in fieldnames or 'latitude' not in fieldnames:
+		logger.info("%s does not have latitude or longitude field. Looking for X & Y fields instead..."%table_name)
+		for orig, new in {'X':'longitude', 'Y':'latitude'}.items():
+			if orig in fieldnames:
+				rename_sql = "ALTER TABLE %s RENAME COLUMN %s TO %s"%(table_name, orig, new) #eg. ALTER TABLE cluster_survey RENAME COLUMN X TO longitude
+				cur.execute(rename_sql)
+				logger.info("In the table, %s, fieldname '%s' has been renamed to '%s'"%(table_name, orig, new))
+				# update fieldnames (replace X with longitude and etc.)
+				for index, fieldname in enumerate(fieldnames):
+					if fieldname == orig:
+						fieldnames[index] = new
+
+	# Note that starting Dec 2020, if the user have not collected lat long, the X, Y value will be blank instead of 0, 0.
+
+	# test data
+	if testdata_index != None:
+		logger.info("Number of deleted records (test data): %s"%counters['test'])
+
+	logger.info("%s rows have been added to '%s' table in the sqlite database."%(row_counter, table_name))
+
+	fieldnames.append(unique_id_fieldname)
+
+	cur.execute("COMMIT")
+	csvfile.close()
+
+	return [table_name, fieldnames, row_counter]
+
+def upsert_table(cur, incoming_table, table_name, unique_id_fieldname, record_identity, version_field, logger):
+	"""
+	incremental ingest. incoming_table has the freshly loaded csv file and table_name is the table kept from the last run.
+	Each record is identified by the first set of fields in record_identity that the form has.
+	eg. record_identity = [['GUID'], ['ClusterNumber', 'ProjectID', 'CreationDateTime']]
+	The record is considered edited if version_field (eg. UpdateDateTime) has changed (or any value if the form has no version_field).
+	Only the new and edited records are written, records no longer in the csv file are deleted,
+	and a record keeps its unique_id from run to run. What happened to each record is written in the ingest_changes table.
+	if incoming_table has an _extra table (column projection), the _extra table of table_name is upserted the same way.
+	record_keys and ingest_changes tables must exist in the same database. the caller takes care of dropping incoming_table (and its _extra table).
+	returns the number of records changed. eg. {'new': 3, 'updated': 1, 'deleted': 0}
+	"""
+	fields = [row[1] for row in cur.execute("PRAGMA table_info(%s)"%incoming_table)]
+	data_fields = [f for f in fields if f != unique_id_fieldname]
+
+	key_fields = None
+	for id_fields in record_identity:
+		if len([f for f in id_fields if f not in data_fields]) == 0:
+			key_fields = id_fields
+			break
+	if key_fields == None:
+		logger.info("!!!! None of the record identity fields %s found in %s. Each record will be identified by all of its values."%(record_identity, table_name))
+		key_fields = data_fields
+	version_fields = [version_field] if version_field in data_fields else data_fields
+	logger.debug("%s records are identified by %s and versioned by %s"%(table_name, key_fields, version_fields if len(version_fields) == 1 else 'all fields'))
+	key_sql = " || '|' || ".join(["IFNULL(CAST(%s AS TEXT), '')"%f for f in key_fields])
+	version_sql = " || '|' || ".join(["quote(%s)"%f for f in version_fields])
+	field_sql = ', '.join(data_fields)
+	incoming_field_sql = ', '.join(['i.%s'%f for f in data_fields])
+
+	cur.execute("BEGIN")
+
+	# the table from the last run can only be updated if it has the same columns (and types) as the new one,
+	# and if every record in it has a key (it could have been replaced by a non-incremental run).
+	rebuild = True
+	if cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)).fetchone()[0] > 0:
+		same_columns = [r[1:3] for r in cur.execute("PRAGMA table_info(%s)"%table_name).fetchall()] == [r[1:3] for r in cur.execute("PRAGMA table_info(%s)"%incoming_table).fetchall()]
+		num_rows = cur.execute("SELECT COUNT(*) FROM %s"%table_name).fetchone()[0]
+		num_keys = cur.execute("SELECT COUNT(*) FROM record_keys WHERE table_name = ?", (table_name,)).fetchone()[0]
+		rebuild = not same_columns or num_rows != num_keys
+		if rebuild:
+			logger.info("!!!! The columns of %s have changed since the last run (or the table has no record keys). Loading all records again."%table_name)
+	if rebuild:
+		cur.execute("DELETE FROM record_keys WHERE table_name = ?", (table_name,))
+		cur.execute("DROP TABLE IF EXISTS %s"%table_name)
+		create_t_sql = cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (incoming_table,)).fetchone()[0]
+		cur.execute(create_t_sql.replace('CREATE TABLE %s'%incoming_table, 'CREATE TABLE %s'%table_name, 1))
+
+	# the columns left out by the column projection (see csv_to_table) are in the _extra tables, under the same unique_id values
+	incoming_extra = incoming_table + '_extra'
+	extra_table = table_name + '_extra'
+	has_extra = cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (incoming_extra,)).fetchone()[0] > 0
+	if rebuild or not has_extra:
+		cur.execute("DROP TABLE IF EXISTS %s"%extra_table)
+	if has_extra:
+		cur.execute("CREATE TABLE IF NOT EXISTS %s (%s integer primary key, data BLOB)"%(extra_table, unique_id_fieldname))
+
+	# key and version of each incoming record. if two records have the same key, the second one gets '#2' at the end of its key and so on.
+	cur.execute("DROP TABLE IF EXISTS temp.incoming_keys")
+	cur.execute("""CREATE TEMP TABLE incoming_keys AS
+		SELECT incoming_uid, record_key || CASE WHEN rn > 1 THEN '#' || rn ELSE '' END AS record_key, record_version
+		FROM (SELECT %s AS incoming_uid, %s AS record_key, %s AS record_version, ROW_NUMBER() OVER (PARTITION BY %s ORDER BY %s) AS rn FROM %s)
+		"""%(unique_id_fieldname, key_sql, version_sql, key_sql, unique_id_fieldname, incoming_table))
+	cur.execute("CREATE INDEX temp.incoming_keys_idx ON incoming_keys (record_key)")
+
+	# deleted
+	cur.execute("""INSERT INTO ingest_changes SELECT table_name, unique_id, record_key, 'deleted' FROM record_keys
+		WHERE table_name = ? AND record_key NOT IN (SELECT record_key FROM incoming_keys)""", (table_name,))
+	for t in [table_name, extra_table] if has_extra else [table_name]:
+		cur.execute("DELETE FROM %s WHERE %s IN (SELECT unique_id FROM ingest_changes WHERE table_name = ? AND change = 'deleted')"%(t, unique_id_fieldname), (table_name,))
+	cur.execute("DELETE FROM record_keys WHERE table_name = ? AND record_key NOT IN (SELECT record_key FROM incoming_keys)", (table_name,))
+
+	# updated - the record is replaced but keeps its unique_id
+	cur.execute("DROP TABLE IF EXISTS temp.updated_records")
+	cur.execute("""CREATE TEMP TABLE updated_records AS SELECT r.unique_id, k.incoming_uid, k.record_key, k.record_version
+		FROM incoming_keys k JOIN record_keys r ON r.table_name = ? AND r.record_key = k.record_key
+		WHERE r.record_version IS NOT k.record_version""", (table_name,))
+	cur.execute("""INSERT OR REPLACE INTO %s (%s, %s) SELECT u.unique_id, %s FROM updated_records u JOIN %s i ON i.%s = u.incoming_uid
+		"""%(table_name, unique_id_fieldname, field_sql, incoming_field_sql, incoming_table, unique_id_fieldname))
+	if has_extra:
+		cur.execute("INSERT OR REPLACE INTO %s SELECT u.unique_id, e.data FROM updated_records u JOIN %s e ON e.%s = u.incoming_uid"%(extra_table, incoming_extra, unique_id_fieldname))
+	cur.execute("INSERT OR REPLACE INTO record_keys SELECT ?, record_key, unique_id, record_version FROM updated_records", (table_name,))
+	cur.execute("INSERT INTO ingest_changes SELECT ?, unique_id, record_key, 'updated' FROM updated_records", (table_name,))
+
+	# new - the new records get the next unique_id values, in the same order as the csv file
+	last_uid = cur.execute("SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = ?), 0), IFNULL((SELECT MAX(%s) FROM %s), 0))"%(unique_id_fieldname, table_name), (table_name,)).fetchone()[0]
+	cur.execute("DROP TABLE IF EXISTS temp.new_records")
+	cur.execute("""CREATE TEMP TABLE new_records AS SELECT ? + ROW_NUMBER() OVER (ORDER BY incoming_uid) AS unique_id, incoming_uid, record_key, record_version
+		FROM incoming_keys WHERE record_key NOT IN (SELECT record_key FROM record_keys WHERE table_name = ?)""", (last_uid, table_name))
+	cur.execute("""INSERT INTO %s (%s, %s) SELECT n.unique_id, %s FROM new_records n JOIN %s i ON i.%s = n.incoming_uid ORDER BY n.unique_id
+		"""%(table_name, unique_id_fieldname, field_sql, incoming_field_sql, incoming_table, unique_id_fieldname))
+	if has_extra:
+		cur.execute("INSERT INTO %s SELECT n.unique_id, e.data FROM new_records n JOIN %s e ON e.%s = n.incoming_uid"%(extra_table, incoming_extra, unique_id_fieldname))
+	cur.execute("INSERT INTO record_keys SELECT ?, record_key, unique_id, record_version FROM new_records", (table_name,))
+	cur.execute("INSERT INTO ingest_changes SELECT ?, unique_id, record_key, 'new' FROM new_records", (table_name,))
+
+	changes = {change: cur.execute("SELECT COUNT(*) FROM ingest_changes WHERE table_name = ? AND change = ?", (table_name, change)).fetchone()[0] for change in ['new', 'updated', 'deleted']}
+	for temp_table in ['incoming_keys', 'updated_records', 'new_records']:
+		cur.execute("DROP TABLE temp.%s"%temp_table)
+	cur.execute("COMMIT")
+	return changes
+
+
+
+class Msg_collector:
+	"""
+	stands in for the logger inside the worker processes.
+	The worker processes can't write to the log file, so the messages are collected here
+	and written to the log by the main process (in the same order) once the worker is done.
+	"""
+	def __init__(self):
+		self.messages = [] # eg. [['info', "working on 'Clearcut_Survey_v2022'"], ['debug', 'Creating a new table: Clearcut_Survey_v2022'],...]
+
+	def debug(self, msg):
+		self.messages.append(['debug', msg])
+
+	def info(self, msg):
+		self.messages.append(['info', msg])
+
+
+
+def ingest_worker(args):
+	"""
+	runs in its own process (see Csv2sqlite.csv_to_sqlite_parallel).
+	loads one csv file into its own staging sqlite database.
+	the staging database is thrown away after the merge, so the ingest pragma profile is always used here.
+	returns [staging_db, table_name, fieldnames, row_counter, log messages]
+	"""
+	csv_fullpath, staging_db, unique_id_fieldname, ignore_testdata, batch_size, column_types, type_sample_rows, keep_columns = args
+	logger = Msg_collector()
+	con = sqlite3.connect(staging_db, isolation_level = None)
+	cur = con.cursor()
+	apply_pragmas(cur, INGEST_PRAGMAS, 'ingest (staging)', logger)
+	table_name, fieldnames, row_counter = csv_to_table(cur, csv_fullpath, unique_id_fieldname, ignore_testdata, batch_size, logger,
+		column_types = column_types, type_sample_rows = type_sample_rows, keep_columns = keep_columns)
+	con.close()
+	return [staging_db, table_name, fieldnames, row_counter, logger.messages]
+
+
+
 class Csv2sqlite:
 	"""turns a list of csv files into tables in a new sqlite database.
 	The newly created sqlite database will have a name like 'SEM_NER_200110110426.sqlite'
 	returns the full path of the newly created db and the number of records in each.
 	"""
-	def __init__(self, csvfolderpath, db_output_path, unique_id_fieldname, logger, ignore_testdata):
+	def __init__(self, csvfolderpath, db_output_path, unique_id_fieldname, logger, ignore_testdata, batch_size = 5000, pragma_profile = False, num_workers = 1, split_workers = 1, split_min_mb = 100,
+		infer_types = False, column_types_csv = None, type_sample_rows = 1000, cache_folderpath = None,
+		column_manifest_csv = None, incremental = False, record_identity = 'GUID; ClusterNumber, ProjectID, CreationDateTime', record_version_field = 'UpdateDateTime'):
 		
 		self.logger = logger
 		self.logger.info('\n')		
@@ -20,6 +609,32 @@ class Csv2sqlite:
 		self.db_path = db_output_path # where you want to save the newly created sqlite file
 		self.unique_id_fieldname = unique_id_fieldname
 		self.ignore_testdata = ignore_testdata
+		self.batch_size = batch_size # number of rows read from the csv and sent to the database at a time (chunk size)
+		self.pragma_profile = pragma_profile # if True, INGEST_PRAGMAS are used while loading the csv files
+		self.num_workers = num_workers # if more than 1, the csv files are loaded at the same time by this many worker processes
+		self.split_workers = split_workers # if more than 1, a csv file bigger than split_min_mb is split into byte ranges and parsed by this many worker processes
+		self.split_min_bytes = split_min_mb*1024*1024
+		# if infer_types is True, the columns get INTEGER, REAL or TEXT types. ColumnTypes.csv (column_types_csv) can override the guess.
+		self.column_types = None # eg. [['ClusterNumber', 'TEXT'], ['Species*NumberofTrees*', 'INTEGER'],...]
+		if infer_types:
+			self.column_types = open_column_types_csv(column_types_csv) if column_types_csv else []
+			self.logger.debug("column_types = %s"%self.column_types)
+		self.type_sample_rows = type_sample_rows
+		# if column_manifest_csv is given, only the columns listed in ColumnManifest.csv are loaded as real columns.
+		# the rest go to a compressed side table (eg. Clearcut_Survey_v2022_extra). see csv_to_table
+		self.keep_columns = None # eg. ['ClusterNumber', 'ProjectID', 'Species*SpeciesNamePlot*',...]
+		if column_manifest_csv:
+			self.keep_columns = open_column_manifest_csv(column_manifest_csv)
+			self.logger.debug("keep_columns = %s"%self.keep_columns)
+		# if cache_folderpath is given, the csv files that haven't changed since the last run are copied from the cache instead of being loaded again.
+		self.cache_folderpath = cache_folderpath
+		# the cached tables can only be reused if they were loaded with the same settings
+		self.ingest_settings = repr([self.unique_id_fieldname, self.ignore_testdata, self.column_types, self.type_sample_rows, self.keep_columns])
+		# if incremental is True, the changed csv files are upserted into the tables kept in the cache instead of replacing them (see upsert_table)
+		self.incremental = incremental and cache_folderpath != None
+		self.record_identity = [[f.strip() for f in id_fields.split(',') if f.strip() != ''] for id_fields in record_identity.split(';') if id_fields.strip() != ''] # eg. [['GUID'], ['ClusterNumber', 'ProjectID', 'CreationDateTime']]
+		self.record_version_field = record_version_field
+		self.changes = {} # eg. {'Clearcut_Survey_v2022': {'new': 3, 'updated': 1, 'deleted': 0},...}
 
 		# self.overwrite = overwrite  <- inactive. delete this unless you need non-overwriting option.
 		self.db_name = ''
@@ -31,7 +646,15 @@ class Csv2sqlite:
 
 		self.generate_db_name()
 		self.getcsvfilelist()
-		self.csv_to_sqlite()
+		if self.cache_folderpath != None:
+			self.check_csv_cache()
+		if self.incremental:
+			self.upsert_csv_files()
+		else:
+			self.csv_to_sqlite()
+		if self.cache_folderpath != None:
+			self.clone_cached_tables()
+			self.update_csv_cache()
 		# self.fix_misspelled_fieldnames() # unnecessary to run this if all fieldnames are correct
 
 		self.logger.debug('db_fullpath_new = %s'%self.db_fullpath_new)
@@ -57,8 +680,10 @@ class Csv2sqlite:
 		"""
 		creates a list of csv file paths based on the input csv folder path
 		"""
-		if os.path.isdir(self.csvfolderpath):
-			self.csvfile_list = [os.path.join(self.csvfolderpath,file) for file in os.listdir(self.csvfolderpath) if file.upper()[-4:] == '.CSV']
+		if os.path.isdir(self.csvfolderpath) or common_functions.split_zip_path(self.csvfolderpath)[0] != None:
+			# the csv files can be inside a zip file (eg. C:\raw_data\RAP_project_2022-07-13_4.zip\data). they are read without extracting the zip file.
+			self.csvfile_list = [os.path.join(self.csvfolderpath,file) for file in common_functions.list_input_files(self.csvfolderpath) if file.upper()[-4:] == '.CSV']
+			self.csvfiles_to_load = list(self.csvfile_list) # csv files that will be loaded. see check_csv_cache
 			if len(self.csvfile_list) == 0:
 				self.logger.info('*** ERROR: No csv file found in the directory: %s'%self.csvfolderpath)
 		else:
@@ -72,117 +697,230 @@ class Csv2sqlite:
 		This module assumes that the fieldnames in those csv files are unique and have no special character.
 		Reads the input csv files and outputs it into the sqlite database.
 		This module is not specific to RAP project csv files, and can be applied to any csv files.
+		One connection is used for all the csv files so the ingest pragma profile (if turned on) is applied only once.
 		"""
+		if self.num_workers > 1 and len(self.csvfiles_to_load) > 1:
+			self.csv_to_sqlite_parallel()
+			return
+
+		# isolation_level = None lets us BEGIN and COMMIT the transaction ourselves (one transaction per table)
+		con = sqlite3.connect(self.db_fullpath_new, isolation_level = None)
+		cur = con.cursor()
+		if self.pragma_profile:
+			apply_pragmas(cur, INGEST_PRAGMAS, 'ingest', self.logger)
+
+		for csv_fullpath in self.csvfiles_to_load:
+			table_name, fieldnames, row_counter = csv_to_table(cur, csv_fullpath, self.unique_id_fieldname, self.ignore_testdata, self.batch_size, self.logger,
+				self.split_workers, self.split_min_bytes, self.column_types, self.type_sample_rows, keep_columns = self.keep_columns)
+			self.tablenames_n_rec_count[table_name] = [fieldnames,row_counter]
 
-		for csv_fullpath in self.csvfile_list:
+		# the pragmas used during the ingest are not safe for the rest of the program. put the safe settings back.
+		if self.pragma_profile:
+			apply_pragmas(cur, SAFE_PRAGMAS, 'safe', self.logger)
+		con.close()
 
-			csvfile = open(csv_fullpath, encoding='utf-8-sig') # this encoding is necessary to remove BOM from the beginning of CSV.
-			reader = csv.reader(csvfile)
-			fieldnames = next(reader) # a list of field names.
-
-			# table name is bascially the csv file name
-			table_name = os.path.split(csv_fullpath)[1]
-			table_name = table_name[:-4] # remove '.csv'
-			table_name = common_functions.no_special_char(table_name)
-			self.logger.info("working on '%s'"%table_name)
-
-			# the sql script for creating a new table
-			create_t_sql = "CREATE TABLE %s "%table_name
-			str_fieldnames = '('
-			for f in fieldnames:
-				str_fieldnames += f + ','
-			str_fieldnames = str_fieldnames[:-1] # to remove the trailing comma
-
-			str_fieldnames += ")"
-
-			# we are going to sneak in a unique_id field that auto-increments as we add data.
-			create_t_sql += str_fieldnames[0] + '%s integer primary key autoincrement, '%self.unique_id_fieldname + str_fieldnames[1:] + ";"
-
-
-			# creating/opening the sql database and table
-			con = sqlite3.connect(self.db_fullpath_new)
-			cur = con.cursor()
-			try:
-				self.logger.debug("Creating a new table: %s"%table_name)
-				# print(create_t_sql)
-				cur.execute(create_t_sql)
-			except:
+
+
+	def csv_to_sqlite_parallel(self):
+		"""
+		Same as csv_to_sqlite, but each csv file (clearcut, shelterwood, project survey, etc.) is loaded 
+		by its own worker process into its own staging database.
+		The staging databases are then merged into the new sqlite database using ATTACH and INSERT ... SELECT.
+		The tables are merged in the same order as self.csvfiles_to_load, so the result is the same as the serial run.
+		"""
+		staging_path = os.path.join(self.db_path, 'staging')
+		if os.path.exists(staging_path):
+			shutil.rmtree(staging_path)
+		os.mkdir(staging_path)
+
+		num_workers = min(self.num_workers, len(self.csvfiles_to_load))
+		self.logger.info("Loading %s csv files using %s worker processes"%(len(self.csvfiles_to_load), num_workers))
+		jobs = []
+		for index, csv_fullpath in enumerate(self.csvfiles_to_load):
+			staging_db = os.path.join(staging_path, 'staging_%s.sqlite'%index)
+			jobs.append([csv_fullpath, staging_db, self.unique_id_fieldname, self.ignore_testdata, self.batch_size, self.column_types, self.type_sample_rows, self.keep_columns])
+
+		start_time = time.time()
+		with multiprocessing.Pool(num_workers) as pool:
+			results = pool.map(ingest_worker, jobs)
+		self.logger.debug("Worker processes finished in %.2f seconds"%(time.time() - start_time))
+
+		# merge
+		con = sqlite3.connect(self.db_fullpath_new, isolation_level = None)
+		cur = con.cursor()
+		if self.pragma_profile:
+			apply_pragmas(cur, INGEST_PRAGMAS, 'ingest', self.logger)
+
+		for staging_db, table_name, fieldnames, row_counter, messages in results:
+			# write down what the worker would have logged
+			for level, msg in messages:
+				if level == 'info':
+					self.logger.info(msg)
+				else:
+					self.logger.debug(msg)
+
+			self.logger.debug("Merging %s into the new sqlite database"%table_name)
+			cur.execute("ATTACH DATABASE ? AS staging", (staging_db,))
+			if table_name in self.tablenames_n_rec_count:
 				self.logger.info("* WARNING: Table '%s' already exists. Dropping and recreating the table."%table_name)
-				cur.execute("DROP TABLE %s"%table_name)	
-				cur.execute(create_t_sql)
-
-
-			# inserting values
-			self.logger.debug("running INSERT statement...")
-			insert_sql = "INSERT INTO %s %s"%(table_name, str_fieldnames)
-			row_counter = 0
-			err_counter = 0
-			for row in reader:
-				# check if number of fieldnames matches with number of values to be inserted
-				# for terraflex projects, this is most likely because lat lon values are missing.
-				if len(fieldnames) < len(row):
-					# this is usually the case where the FIELDNAME "latitude" or "longitude" is missing
-					err_counter += 1
-					continue
-
-				if len(fieldnames) > len(row):
-					# this is usually the case where the VALUE of "latitude" or "longitude" is missing
-					# This can be resolved by putting 0 in the place of those missing values.
-					difference = len(fieldnames) - len(row)
-					blank_fill = [0 for i in range(difference)]  # [0, 0, 0] if 3 values are missing.
-					row = row + blank_fill
-
-				val = str(tuple(row))
-				values_sql = " VALUES %s;"%val
-				sql = insert_sql + values_sql
-				# print(sql)
-				cur.execute(sql)
-				row_counter += 1
-
-			if err_counter > 0:
-				self.logger.info("* WARNING: Some fieldnames (such as lat long) seems to be missing in table %s. This can be caused by \
-					the most recently added project or cluster survey not having gps coordinates collected."%table_name)
-
-			# check if fieldnames include latitude and longitude
-			# starting Dec 2020, there are not latitude and longitude field in terraflex connect,
-			# 	instead, they have X, and Y fields. So we need to manually create latitude and longitude fields.
-			# this is done by renaming attribute names. X = longitude, Y = latitude
-			if 'longitude' not in fieldnames or 'latitude' not in fieldnames:
-				self.logger.info("%s does not have latitude or longitude field. Looking for X & Y fields instead..."%table_name)
-				for orig, new in {'X':'longitude', 'Y':'latitude'}.items():
-					if orig in fieldnames:
-						rename_sql = "ALTER TABLE %s RENAME COLUMN %s TO %s"%(table_name, orig, new) #eg. ALTER TABLE cluster_survey RENAME COLUMN X TO longitude
-						cur.execute(rename_sql)
-						self.logger.info("In the table, %s, fieldname '%s' has been renamed to '%s'"%(table_name, orig, new))
-						# update fieldnames (replace X with longitude and etc.)
-						for index, fieldname in enumerate(fieldnames):
-							if fieldname == orig:
-								fieldnames[index] = new
-
-			# Note that starting Dec 2020, if the user have not collected lat long, the X, Y value will be blank instead of 0, 0.
-
-			# delete test data
-			if self.ignore_testdata == True:
-				self.logger.debug("deleting test data records...")
-				delete_sql = "DELETE FROM %s WHERE TestData = 'Yes';"%table_name
-				# for example, DELETE FROM l387081_Cluster_Survey_Testing_ WHERE TestData = 'Yes';
-				cur.execute(delete_sql)
-
-				# count remaining records
-				count_sql = "SELECT * FROM %s"%table_name
-				count = len(cur.execute(count_sql).fetchall())
-				deleted_counter = row_counter - count
-				self.logger.info("Number of deleted records (test data): %s"%deleted_counter)
-				row_counter = count
-
-			self.logger.info("%s rows have been added to '%s' table in the sqlite database."%(row_counter, table_name))
-
-			fieldnames.append(self.unique_id_fieldname)
+			cur.execute("BEGIN")
+			copy_table(cur, table_name, 'staging', 'main') # creates the same table (with the same unique_id values) in the main database
+			cur.execute("COMMIT")
+			cur.execute("DETACH DATABASE staging")
+
+			# the worker counted the rows as it read them. double check it here since the rows went through another database.
+			merged_count = cur.execute("SELECT COUNT(*) FROM main.%s"%table_name).fetchone()[0]
+			if merged_count != row_counter:
+				self.logger.info("* WARNING: %s rows were loaded into %s but %s rows were merged."%(row_counter, table_name, merged_count))
+				row_counter = merged_count
 			self.tablenames_n_rec_count[table_name] = [fieldnames,row_counter]
 
-			con.commit()
-			con.close()
-			csvfile.close()
+		if self.pragma_profile:
+			apply_pragmas(cur, SAFE_PRAGMAS, 'safe', self.logger)
+		con.close()
+
+		shutil.rmtree(staging_path)
+		self.logger.info("%s csv files loaded and merged in %.2f seconds"%(len(results), time.time() - start_time))
+
+
+
+	def check_csv_cache(self):
+		"""
+		compares the fingerprint (size, modified time and sha256) of each csv file with the one saved in the cache by the last run.
+		The tables of the csv files that haven't changed are copied from the cache (see clone_cached_tables),
+		so only the new or changed csv files are left in self.csvfiles_to_load.
+		"""
+		self.cache_db = os.path.join(self.cache_folderpath, 'csv_ingest_cache.sqlite')
+		self.logger.debug("Checking the csv files against the cache: %s"%self.cache_db)
+		con = sqlite3.connect(self.cache_db, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("""CREATE TABLE IF NOT EXISTS csv_fingerprints (csv_filename TEXT PRIMARY KEY, table_name TEXT, size INTEGER, mtime REAL, sha256 TEXT,
+			settings TEXT, fieldnames TEXT, row_count INTEGER)""")
+		# eg. {'Clearcut_Survey_v2022.csv': ['Clearcut_Survey_v2022', 1520384, 1657812345.123, 'e3b0c442...', "['unique_id', True,...]", '["ClusterNumber",...]', 2011],...}
+		# used by the incremental ingest. see upsert_table
+		cur.execute("CREATE TABLE IF NOT EXISTS record_keys (table_name TEXT, record_key TEXT, unique_id INTEGER, record_version TEXT, PRIMARY KEY (table_name, record_key))")
+		cur.execute("CREATE TABLE IF NOT EXISTS ingest_changes (table_name TEXT, unique_id INTEGER, record_key TEXT, change TEXT)")
+		cached = {row[0]: list(row[1:]) for row in cur.execute("SELECT * FROM csv_fingerprints")}
+		con.close()
+
+		self.csv_fingerprints = {} # eg. {'C:\\...\\Clearcut_Survey_v2022.csv': [1520384, 1657812345.123, 'e3b0c442...'],...}
+		self.cached_tables = [] # eg. [['Clearcut_Survey_v2022', fieldnames, row_count],...]
+		self.csvfiles_to_load = []
+		for csv_fullpath in self.csvfile_list:
+			csv_filename = os.path.split(csv_fullpath)[1]
+			old = cached.get(csv_filename)
+			old_fingerprint = old[1:4] if old != None else None
+			fingerprint = common_functions.file_fingerprint(csv_fullpath, old_fingerprint)
+			self.csv_fingerprints[csv_fullpath] = fingerprint
+
+			if old != None and fingerprint[0] == old[1] and fingerprint[2] == old[3] and old[4] == self.ingest_settings:
+				self.logger.info("'%s' hasn't changed since the last run. Its table will be copied from the cache."%csv_filename)
+				self.cached_tables.append([old[0], json.loads(old[5]), old[6]])
+			else:
+				self.csvfiles_to_load.append(csv_fullpath)
+
+		self.logger.info("%s csv files unchanged (copied from the cache), %s csv files to load."%(len(self.cached_tables), len(self.csvfiles_to_load)))
+
+
+
+	def upsert_csv_files(self):
+		"""
+		incremental ingest. Each changed csv file is loaded into the cache database and upserted into the table kept there from the last run,
+		so only the new and edited records are written and every record keeps its unique_id from run to run.
+		The upserted tables are then copied into the new sqlite database with the unchanged ones (see clone_cached_tables),
+		along with the ingest_changes table that lists the new, updated and deleted records of this run.
+		"""
+		con = sqlite3.connect(self.cache_db, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("DELETE FROM ingest_changes")
+
+		for csv_fullpath in self.csvfiles_to_load:
+			table_name = csv_table_name(csv_fullpath)
+			incoming_table = 'incoming_%s'%table_name
+			cur.execute("DROP TABLE IF EXISTS %s"%incoming_table)
+			incoming_table, fieldnames, row_counter = csv_to_table(cur, csv_fullpath, self.unique_id_fieldname, self.ignore_testdata, self.batch_size, self.logger,
+				self.split_workers, self.split_min_bytes, self.column_types, self.type_sample_rows, table_name = incoming_table, keep_columns = self.keep_columns)
+
+			self.changes[table_name] = upsert_table(cur, incoming_table, table_name, self.unique_id_fieldname, self.record_identity, self.record_version_field, self.logger)
+			cur.execute("DROP TABLE %s"%incoming_table)
+			cur.execute("DROP TABLE IF EXISTS %s_extra"%incoming_table)
+			self.logger.info("Upserted %s: %s"%(table_name, self.changes[table_name]))
+			row_count = cur.execute("SELECT COUNT(*) FROM %s"%table_name).fetchone()[0]
+			self.cached_tables.append([table_name, fieldnames, row_count])
+		con.close()
+
+
+
+	def clone_cached_tables(self):
+		"""
+		copies the tables of the unchanged csv files from the cache into the new sqlite database.
+		the copied tables are exactly the same as the ones loaded in the last run (including the unique_id values).
+		in incremental mode, the upserted tables and the ingest_changes table are copied as well.
+		"""
+		if len(self.cached_tables) == 0 and not self.incremental:
+			return
+		con = sqlite3.connect(self.db_fullpath_new, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("ATTACH DATABASE ? AS cache", (self.cache_db,))
+		cur.execute("BEGIN")
+		for table_name, fieldnames, row_count in self.cached_tables:
+			self.logger.debug("Copying %s from the cache"%table_name)
+			copy_table(cur, table_name, 'cache', 'main')
+			self.tablenames_n_rec_count[table_name] = [fieldnames, row_count]
+		if self.incremental:
+			copy_table(cur, 'ingest_changes', 'cache', 'main')
+		cur.execute("COMMIT")
+		cur.execute("DETACH DATABASE cache")
+		con.close()
+
+		# put the tables back in the same order as the csv files
+		table_order = [csv_table_name(csv_fullpath) for csv_fullpath in self.csvfile_list]
+		self.tablenames_n_rec_count = {t: self.tablenames_n_rec_count[t] for t in table_order if t in self.tablenames_n_rec_count}
+
+
+
+	def update_csv_cache(self):
+		"""
+		saves the tables of the csv files that were just loaded, and the fingerprints of all the csv files, in the cache for the next run.
+		csv files that are no longer in the input folder are removed from the cache.
+		everything is done in one transaction so the cache is never left half updated.
+		"""
+		con = sqlite3.connect(self.db_fullpath_new, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("ATTACH DATABASE ? AS cache", (self.cache_db,))
+		cur.execute("BEGIN")
+
+		csv_filenames = [os.path.split(csv_fullpath)[1] for csv_fullpath in self.csvfile_list]
+		for csv_filename, table_name in cur.execute("SELECT csv_filename, table_name FROM cache.csv_fingerprints").fetchall():
+			if csv_filename not in csv_filenames:
+				self.logger.debug("Removing %s from the cache"%csv_filename)
+				cur.execute("DELETE FROM cache.csv_fingerprints WHERE csv_filename = ?", (csv_filename,))
+				if table_name not in self.tablenames_n_rec_count:
+					cur.execute("DROP TABLE IF EXISTS cache.%s"%table_name)
+					cur.execute("DROP TABLE IF EXISTS cache.%s_extra"%table_name)
+					cur.execute("DELETE FROM cache.record_keys WHERE table_name = ?", (table_name,))
+
+		for csv_fullpath in self.csvfile_list:
+			csv_filename = os.path.split(csv_fullpath)[1]
+			size, mtime, sha256 = self.csv_fingerprints[csv_fullpath]
+			if csv_fullpath in self.csvfiles_to_load:
+				table_name = csv_table_name(csv_fullpath)
+				fieldnames, row_count = self.tablenames_n_rec_count[table_name]
+				if not self.incremental:
+					# in incremental mode the table in the cache has already been upserted
+					copy_table(cur, table_name, 'main', 'cache')
+					cur.execute("DELETE FROM cache.record_keys WHERE table_name = ?", (table_name,))
+				cur.execute("INSERT OR REPLACE INTO cache.csv_fingerprints VALUES (?,?,?,?,?,?,?,?)",
+					(csv_filename, table_name, size, mtime, sha256, self.ingest_settings, json.dumps(fieldnames), row_count))
+			else:
+				# same content, but the file may have a new modified time (eg. downloaded again). saving it means no hashing next time.
+				cur.execute("UPDATE cache.csv_fingerprints SET mtime = ? WHERE csv_filename = ?", (mtime, csv_filename))
+
+		cur.execute("COMMIT")
+		cur.execute("DETACH DATABASE cache")
+		con.close()
+		self.logger.debug("Cache updated with %s csv files"%len(self.csvfiles_to_load))
+
 
 
 	def fix_misspelled_fieldnames(self):
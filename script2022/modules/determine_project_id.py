@@ -5,7 +5,7 @@
 # The shapefile must...
 # contain "ProjectID" field (can be text or integer).
 # values in the "ProjectID" field must be unique (i.e. no dupilcates in ProjectID)
-# be in NAD83 or WGS84 geographic coordinates. ??? may be not.
+# be in NAD83 or WGS84 geographic coordinates, or in a projected coordinate system (eg. MNR Lambert) if osgeo is installed.
 # 
 # Unfortunately for this 2021 season, there are more than one projectID field in the terraflex form (and thus in the sqlite table)
 # 1. ProjectID: The original ProjectID field ,but this one is archieved and is NO LONGER BEING USED. Ignore this field!!
@@ -30,8 +30,14 @@
 # Created by Daniel Kim.
 
 
-import os, sqlite3
-from osgeo import ogr
+import os, json, math, struct, hashlib, sqlite3, multiprocessing
+import numpy as np
+from scipy.spatial import cKDTree
+try:
+	from osgeo import ogr, osr
+except ImportError:
+	ogr = None
+	osr = None
 
 # importing custom modules
 if __name__ == '__main__':
@@ -40,6 +46,412 @@ else:
 	from modules import common_functions
 
 
+
+def wkb_to_rings(wkb):
+	"""
+	reads the rings of a Polygon or MultiPolygon WKB (either byte order, 2D or with Z/M values) without OGR.
+	returns a list of numpy arrays of (x, y) points, one per ring (outer rings and holes together).
+	raises ValueError for any other geometry type.
+	"""
+	rings = []
+
+	def read(offset, expected_types):
+		byte_order = '<' if wkb[offset] == 1 else '>'
+		geom_type = struct.unpack(byte_order + 'I', wkb[offset + 1:offset + 5])[0]
+		has_z, has_m = bool(geom_type & 0x80000000), bool(geom_type & 0x40000000)
+		geom_type &= 0x0FFFFFFF
+		if geom_type >= 1000:
+			# ISO WKB eg. 1003 = Polygon Z, 2003 = Polygon M, 3003 = Polygon ZM
+			has_z, has_m = geom_type // 1000 in [1, 3], geom_type // 1000 in [2, 3]
+			geom_type %= 1000
+		if geom_type not in expected_types:
+			raise ValueError('WKB geometry type %s is not supported'%geom_type)
+		dims = 2 + has_z + has_m
+		count = struct.unpack(byte_order + 'I', wkb[offset + 5:offset + 9])[0]
+		offset += 9
+		if geom_type == 6: # MultiPolygon
+			for n in range(count):
+				offset = read(offset, [3])
+			return offset
+		for n in range(count): # Polygon
+			num_points = struct.unpack(byte_order + 'I', wkb[offset:offset + 4])[0]
+			points = np.frombuffer(wkb, dtype = byte_order + 'f8', count = num_points * dims, offset = offset + 4).reshape(-1, dims)
+			rings.append(points[:, :2])
+			offset += 4 + 8 * num_points * dims
+		return offset
+
+	read(0, [3, 6])
+	return rings
+
+
+def rings_to_edges(rings):
+	"""
+	puts the edges of all the rings of a polygon into four arrays: [x1, y1, x2, y2]
+	"""
+	x1 = np.concatenate([ring[:-1, 0] for ring in rings])
+	y1 = np.concatenate([ring[:-1, 1] for ring in rings])
+	x2 = np.concatenate([ring[1:, 0] for ring in rings])
+	y2 = np.concatenate([ring[1:, 1] for ring in rings])
+	return [x1, y1, x2, y2]
+
+
+def points_in_polygon(xs, ys, edges, max_cells = 2000000):
+	"""
+	even-odd ray casting of many points against one polygon at once. xs, ys: numpy arrays of the point coordinates.
+	a horizontal ray from each point crosses the edges of the polygon (outer rings, holes and other parts of a multipolygon) -
+	an odd number of crossings means the point is inside. this takes care of the holes and the multipolygons without looking at the ring order.
+	the points are done in chunks so that a (points x edges) array has no more than max_cells cells.
+	returns a numpy array of True/False.
+	"""
+	x1, y1, x2, y2 = [edge[np.newaxis, :] for edge in edges]
+	inside = np.zeros(len(xs), dtype = bool)
+	chunk_size = max(1, max_cells // max(1, x1.shape[1]))
+	for start in range(0, len(xs), chunk_size):
+		px = xs[start:start + chunk_size, np.newaxis]
+		py = ys[start:start + chunk_size, np.newaxis]
+		straddles = (y1 > py) != (y2 > py)
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+		crossings = np.count_nonzero(straddles & (px < x_cross), axis = 1)
+		inside[start:start + chunk_size] = crossings % 2 == 1
+	return inside
+
+
+
+def prepare_projects(projects, engine):
+	"""
+	turns the projects ([[proj_id, wkb],...]) into what the matching engine needs, so that nothing has to be read from the polygons while matching.
+	'ogr': [[proj_id, ogr geometry, envelope],...]   'numpy': [[proj_id, edges (see rings_to_edges), envelope],...]
+	envelope is [minx, miny, maxx, maxy]. a project without a polygon gets None for both.
+	raises ValueError if the numpy engine can't read a polygon (see wkb_to_rings).
+	"""
+	prepared = []
+	for proj_id, wkb in projects:
+		geom, envelope = None, None
+		if wkb != None and engine == 'ogr':
+			# the polygons were saved as WKB by shp2sqlite. https://gdal.org/python/osgeo.ogr.Geometry-class.html
+			geom = ogr.CreateGeometryFromWkb(wkb)
+			minx, maxx, miny, maxy = geom.GetEnvelope()
+			envelope = [minx, miny, maxx, maxy]
+		elif wkb != None:
+			rings = wkb_to_rings(wkb)
+			if len(rings) > 0:
+				geom = rings_to_edges(rings)
+				x1, y1, x2, y2 = geom
+				envelope = [float(min(x1.min(), x2.min())), float(min(y1.min(), y2.min())), float(max(x1.max(), x2.max())), float(max(y1.max(), y2.max()))]
+		prepared.append([proj_id, geom, envelope])
+	return prepared
+
+
+def match_points_ogr(points, prepared, candidates = None):
+	"""
+	finds the first project polygon (in the shapefile's order) that each point is within, using OGR's Within.
+	points: [[key, lon, lat],...] (or x, y in the shapefile's coordinate system, see Determine_project_id.to_layer_coords) prepared: see prepare_projects (ogr)
+	candidates: the candidate projects of each point (see Determine_project_id.get_rtree_candidates). if None, Envelope_tree is used.
+	returns a list with the index of the matching project (or None) for each point.
+	"""
+	geoms = [proj[1] for proj in prepared]
+	if candidates == None:
+		# spatial index of the project polygons
+		tree = Envelope_tree([proj[2] for proj in prepared])
+		candidates = (tree.query(lon, lat) for key, lon, lat in points)
+
+	# one point geometry object is moved from cluster to cluster
+	pt = ogr.Geometry(ogr.wkbPoint)
+	pt.AddPoint_2D(0.0, 0.0)
+
+	matches = []
+	for (key, lon, lat), point_candidates in zip(points, candidates):
+		pt.SetPoint_2D(0, lon, lat) # long, lat is apparently the default setting.
+
+		# iterate through the project polygon shapes whose envelope contains the point (in the shapefile's order)
+		match = None
+		for i in point_candidates:
+			# Within is the method that checks if point a is within point b.
+			if pt.Within(geoms[i]):
+				match = i
+				break
+		matches.append(match)
+
+	# delete the point geometry object
+	del pt
+	return matches
+
+
+def match_points_numpy(points, prepared):
+	"""
+	same as match_points_ogr but without OGR: all the points are tested against one polygon at a time with numpy (see points_in_polygon).
+	the polygons are gone through in the shapefile's order and a point that already has a match is not tested again,
+	so each point gets the first polygon it falls in.
+	prepared: see prepare_projects (numpy)
+	"""
+	xs = np.array([point[1] for point in points], dtype = float)
+	ys = np.array([point[2] for point in points], dtype = float)
+	result = np.full(len(points), -1, dtype = np.int64)
+
+	for i, (proj_id, edges, envelope) in enumerate(prepared):
+		if edges == None:
+			continue
+		minx, miny, maxx, maxy = envelope
+		candidates = np.nonzero((result == -1) & (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy))[0]
+		if len(candidates) == 0:
+			continue
+		inside = points_in_polygon(xs[candidates], ys[candidates], edges)
+		result[candidates[inside]] = i
+
+	return [int(i) if i != -1 else None for i in result]
+
+
+earth_radius_m = 6371008.8 # mean radius of the earth
+m_per_deg = earth_radius_m * math.pi / 180 # metres in one degree of lat
+
+def unit_lengths(y, units_m = None):
+	"""
+	metres in one unit of x and in one unit of y around y.
+	units_m is the metres in one unit of a projected coordinate system (eg. 1.0 for MNR Lambert).
+	if it's None, x, y are lon, lat in degrees and one degree of lon gets shorter with the cos of the lat.
+	"""
+	if units_m == None:
+		return m_per_deg * math.cos(math.radians(y)), m_per_deg
+	return units_m, units_m
+
+
+def lonlat_to_xyz(lons, lats):
+	"""
+	puts the lon, lat (degrees) on a sphere the size of the earth (x, y, z in metres).
+	the straight-line distance between two of these points gets bigger as the distance on the ground gets bigger,
+	so the nearest point in a KD-tree of x, y, z is also the nearest point on the ground.
+	"""
+	lons, lats = np.radians(lons), np.radians(lats)
+	return np.column_stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)]) * earth_radius_m
+
+
+def boundary_distance(edges, x, y, units_m = None):
+	"""
+	distance in metres from the point to the closest edge of the polygon (edges: see rings_to_edges).
+	for lon, lat it's measured on a flat plane around the point (lon is scaled by the cos of the point's lat),
+	which is good enough for the distances we care about here (up to a few km). see unit_lengths for units_m.
+	"""
+	x1, y1, x2, y2 = edges
+	kx, ky = unit_lengths(y, units_m)
+	ax, ay = (x1 - x) * kx, (y1 - y) * ky
+	dx, dy = (x2 - x1) * kx, (y2 - y1) * ky
+	length_sq = dx * dx + dy * dy
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		t = np.where(length_sq > 0, np.clip(-(ax * dx + ay * dy) / length_sq, 0, 1), 0)
+	return float(np.hypot(ax + t * dx, ay + t * dy).min())
+
+
+def nearest_projects(points, prepared, units_m = None, k = 8):
+	"""
+	finds the nearest project polygon of each point and the distance (in metres) from the point to the polygon's boundary.
+	points: [[key, x, y],...] (lon, lat unless units_m is given, see unit_lengths) prepared: see prepare_projects (numpy)
+	a KD-tree of all the vertices and centroids of the polygons gives the k nearest projects of each point, and the closest of their boundaries
+	is the first guess. every other project whose bounding box is closer than that guess is then measured too, so the answer is exact.
+	the distances are measured the same way as in boundary_distance.
+	returns a list of [index of the nearest project, distance in metres] (or None if there are no polygons) for each point.
+	"""
+	proj_indices = [i for i, proj in enumerate(prepared) if proj[1] != None]
+	if len(proj_indices) == 0:
+		return [None for point in points]
+
+	# lon, lat go on the sphere (see lonlat_to_xyz). projected x, y can go into the KD-tree as they are.
+	to_tree_coords = lonlat_to_xyz if units_m == None else lambda xs, ys: np.column_stack([xs, ys])
+
+	# KD-tree of the vertices and the centroids (vertex average) of the polygons. tree_owner: the project of each tree point
+	xs, ys, tree_owner = [], [], []
+	for i in proj_indices:
+		x1, y1 = prepared[i][1][0], prepared[i][1][1]
+		xs += [x1, [x1.mean()]]
+		ys += [y1, [y1.mean()]]
+		tree_owner.append(np.full(len(x1) + 1, i, dtype = np.int64))
+	tree = cKDTree(to_tree_coords(np.concatenate(xs), np.concatenate(ys)))
+	tree_owner = np.concatenate(tree_owner)
+	envelopes = np.array([prepared[i][2] for i in proj_indices], dtype = float)
+
+	tree_coords = to_tree_coords(np.array([point[1] for point in points], dtype = float), np.array([point[2] for point in points], dtype = float))
+	nearest_tree_points = tree.query(tree_coords, k = min(k, len(tree_owner)))[1].reshape(len(points), -1)
+
+	results = []
+	for (key, x, y), tree_points in zip(points, nearest_tree_points):
+		kx, ky = unit_lengths(y, units_m)
+		best = None
+		for i in sorted(set(tree_owner[tree_points].tolist())):
+			dist = boundary_distance(prepared[i][1], x, y, units_m)
+			if best == None or dist < best[1]:
+				best = [i, dist]
+		# distance to each bounding box. no part of a polygon is closer than its box.
+		box_dx = np.maximum(np.maximum(envelopes[:, 0] - x, x - envelopes[:, 2]), 0) * kx
+		box_dy = np.maximum(np.maximum(envelopes[:, 1] - y, y - envelopes[:, 3]), 0) * ky
+		for n in np.nonzero(np.hypot(box_dx, box_dy) < best[1])[0]:
+			i = proj_indices[n]
+			dist = boundary_distance(prepared[i][1], x, y, units_m)
+			if dist < best[1] or (dist == best[1] and i < best[0]):
+				best = [i, dist]
+		results.append(best)
+	return results
+
+
+def scale_geometry(geom, x_factor, y_factor):
+	"""
+	multiplies the x and y of every point of an OGR geometry (and of its parts and rings) by the factors, in place.
+	"""
+	if geom.GetGeometryCount() > 0:
+		for n in range(geom.GetGeometryCount()):
+			scale_geometry(geom.GetGeometryRef(n), x_factor, y_factor)
+	else:
+		for n in range(geom.GetPointCount()):
+			geom.SetPoint_2D(n, geom.GetX(n) * x_factor, geom.GetY(n) * y_factor)
+
+
+def buffer_projects(projects, tolerance_m, units_m = None):
+	"""
+	makes the buffered polygon (tolerance_m metres around the project polygon) of each project with OGR's Buffer.
+	polygons in lat, lon are stretched to metres around their own centre (lon is scaled by the cos of its lat),
+	buffered, and put back in lat, lon. the buffers are only a few metres wide, so this is as good as buffering in a projected coordinate system.
+	polygons in a projected coordinate system (units_m, see unit_lengths) are buffered as they are.
+	projects: [[proj_id, wkb],...]  returns [[proj_id, buffered wkb],...] in the same order. a project without a polygon gets None.
+	"""
+	buffered = []
+	for proj_id, wkb in projects:
+		if wkb == None:
+			buffered.append([proj_id, None])
+			continue
+		geom = ogr.CreateGeometryFromWkb(wkb)
+		minx, maxx, miny, maxy = geom.GetEnvelope()
+		kx, ky = unit_lengths((miny + maxy) / 2, units_m)
+		scale_geometry(geom, kx, ky)
+		geom = geom.Buffer(tolerance_m)
+		scale_geometry(geom, 1 / kx, 1 / ky)
+		buffered.append([proj_id, bytes(geom.ExportToWkb())])
+	return buffered
+
+
+def match_points_within_distance(points, prepared, tolerance_m, units_m = None):
+	"""
+	used instead of the buffered polygons when OGR (GEOS) is not there to make them.
+	a point that is outside the polygon is in the buffer if it's within tolerance_m metres of the polygon's boundary (see boundary_distance),
+	which is exactly what the buffer is. the envelopes, stretched by tolerance_m, go into an Envelope_tree so only the nearby polygons are measured.
+	prepared: see prepare_projects (numpy). returns the index of the first project (in the shapefile's order) for each point, or None.
+	"""
+	boxes = []
+	for proj_id, edges, envelope in prepared:
+		if envelope == None:
+			boxes.append(None)
+			continue
+		minx, miny, maxx, maxy = envelope
+		if units_m == None:
+			# one degree of lon is shortest at the lat furthest from the equator
+			dy = tolerance_m / m_per_deg
+			dx = tolerance_m / unit_lengths(min(89.0, max(abs(miny - dy), abs(maxy + dy))))[0]
+		else:
+			dx = dy = tolerance_m / units_m
+		boxes.append([minx - dx, miny - dy, maxx + dx, maxy + dy])
+	tree = Envelope_tree(boxes)
+
+	matches = []
+	for key, x, y in points:
+		match = None
+		for i in tree.query(x, y):
+			if boundary_distance(prepared[i][1], x, y, units_m) <= tolerance_m:
+				match = i
+				break
+		matches.append(match)
+	return matches
+
+
+# each worker process of Determine_project_id.geo_match_parallel keeps its own prepared projects here. eg. ['numpy', [[proj_id, edges, envelope],...]]
+worker_prepared_projects = None
+
+def geo_match_worker_init(projects, engine):
+	"""
+	runs once in each worker process (see Determine_project_id.geo_match_parallel).
+	"""
+	global worker_prepared_projects
+	worker_prepared_projects = [engine, prepare_projects(projects, engine)]
+
+
+def geo_match_worker(points):
+	"""
+	runs in a worker process. matches one shard of the points.
+	"""
+	engine, prepared = worker_prepared_projects
+	if engine == 'numpy':
+		return match_points_numpy(points, prepared)
+	return match_points_ogr(points, prepared)
+
+
+
+class Envelope_tree:
+	"""
+	R-tree over the bounding boxes (envelopes) of the project polygons, packed with the Sort-Tile-Recursive (STR) method.
+	a point only needs to be tested against the polygons whose boxes contain it. see query().
+	boxes: [[minx, miny, maxx, maxy],...] one per polygon, in the shapefile's order. None (no geometry) is never returned.
+	reference: Leutenegger, Lopez and Edgington (1997) STR: A Simple and Efficient Algorithm for R-Tree Packing
+	"""
+	def __init__(self, boxes, node_capacity = 16):
+		self.node_capacity = node_capacity
+		self.boxes = [box for box in boxes] # eg. [[-81.19, 48.49, -81.17, 48.51], None,...]
+		self.levels = [] # root level first. each level is [node boxes, node children]. the children of the last level are polygon indices.
+
+		items = np.array([i for i, box in enumerate(self.boxes) if box != None], dtype = np.int64)
+		if len(items) == 0:
+			return
+		level_boxes = np.array([self.boxes[i] for i in items], dtype = float)
+		level_ids = items
+		while True:
+			groups = self.pack(level_boxes)
+			node_boxes = [[level_boxes[g, 0].min(), level_boxes[g, 1].min(), level_boxes[g, 2].max(), level_boxes[g, 3].max()] for g in groups]
+			self.levels.insert(0, [node_boxes, [level_ids[g].tolist() for g in groups]])
+			if len(groups) == 1:
+				break
+			level_boxes = np.array(node_boxes)
+			level_ids = np.arange(len(groups))
+
+
+	def pack(self, boxes):
+		"""
+		sorts the boxes by the x of their centres, cuts them into vertical slices, sorts each slice by the y of the centres,
+		and fills the nodes with node_capacity boxes each. returns a list of arrays of positions in boxes.
+		"""
+		num_nodes = math.ceil(len(boxes) / self.node_capacity)
+		slice_size = math.ceil(math.sqrt(num_nodes)) * self.node_capacity
+		centre_x = (boxes[:, 0] + boxes[:, 2]) / 2
+		centre_y = (boxes[:, 1] + boxes[:, 3]) / 2
+		order = np.argsort(centre_x, kind = 'stable')
+		groups = []
+		for start in range(0, len(boxes), slice_size):
+			vertical_slice = order[start:start + slice_size]
+			vertical_slice = vertical_slice[np.argsort(centre_y[vertical_slice], kind = 'stable')]
+			groups += [vertical_slice[n:n + self.node_capacity] for n in range(0, len(vertical_slice), self.node_capacity)]
+		return groups
+
+
+	def query(self, x, y):
+		"""
+		returns the indices of the polygons whose boxes contain the point (edges included), in ascending order.
+		testing them in this order gives the same first match as going through all the polygons in the shapefile's order.
+		"""
+		if len(self.levels) == 0:
+			return []
+		nodes = [0]
+		for node_boxes, node_children in self.levels:
+			next_nodes = []
+			for n in nodes:
+				minx, miny, maxx, maxy = node_boxes[n]
+				if minx <= x <= maxx and miny <= y <= maxy:
+					next_nodes += node_children[n]
+			nodes = next_nodes
+		candidates = []
+		for i in nodes:
+			minx, miny, maxx, maxy = self.boxes[i]
+			if minx <= x <= maxx and miny <= y <= maxy:
+				candidates.append(i)
+		candidates.sort()
+		return candidates
+
+
+
 class Determine_project_id:
 	"""
 	Use 'run_all' method to run all the methods at once.
@@ -51,10 +463,23 @@ class Determine_project_id:
 		self.prjID_field = cfg_dict['SHP']['project_id_fieldname']
 		self.silvsys_fieldname = 'SILVSYS'
 		self.shp2sqlite_tablename = cfg_dict['SHP']['shp2sqlite_tablename']		
+		self.shp_geom_field = cfg_dict['SHP']['shp2sqlite_geom_fieldname']
+		self.shp_info_tablename = self.shp2sqlite_tablename + '_info' # written by shp2sqlite
+		self.shp_rtree_tablename = self.shp2sqlite_tablename + '_rtree' # written by shp2sqlite (if the sqlite library has the R*Tree module)
+		self.cluster_points_tblname = cfg_dict['SQLITE']['cluster_points_tblname'] # REAL coordinates of every cluster. see save_cluster_points
 		self.geo_check_field = cfg_dict['SQLITE']['geo_check_fieldname'] # this field will be created in the sqlite database for each record in cluster table as each record gets assigned to each projectid.
 		self.fin_proj_id_field = cfg_dict['SQLITE']['fin_proj_id']
 		self.proj_id_override = cfg_dict['SQLITE']['proj_id_override'] # if this field is filled out by the end-user, it should override the geomatrically found project id.
 		self.unique_id_field = cfg_dict['SQLITE']['unique_id_fieldname']
+		self.geo_engine = cfg_dict['SHP']['geo_engine'].strip().lower() # 'ogr' or 'numpy'
+		self.geo_workers = int(cfg_dict['SHP']['geo_workers'])
+		self.reuse_geo_matches = eval(cfg_dict['SHP']['reuse_geo_matches'])
+		self.geo_cache_decimals = int(cfg_dict['SHP']['geo_cache_decimals'])
+		self.gps_tolerance_m = float(cfg_dict['SHP']['gps_tolerance_m'])
+		self.cache_folderpath = common_functions.get_cache_folderpath(cfg_dict) if self.reuse_geo_matches or self.gps_tolerance_m > 0 else None
+		self.nearest_project_fallback = eval(cfg_dict['SHP']['nearest_project_fallback'])
+		self.nearest_proj_field = cfg_dict['SQLITE']['nearest_proj_id_fieldname'] # nearest project of the clusters that are outside of every project polygon
+		self.nearest_dist_field = cfg_dict['SQLITE']['nearest_proj_dist_fieldname'] # and the distance to it in metres
 
 
 		# other static and non-static variables that brought into this class:
@@ -63,10 +488,10 @@ class Determine_project_id:
 		self.logger = logger
 
 		# instance variables to be assigned as we go through each module.
-		self.dataSource = None
-		self.layer = None
 		self.layer_featureCount = None
-		self.spatialRef = None
+		self.spatialRef = None # WKT
+		self.layer_units_m = None # metres in one unit of the shapefile's projected coordinate system. None if the shapefile is in geographic coordinates
+		self.to_layer_transform = None # osr CoordinateTransformation from WGS84 lon, lat to the shapefile's projected coordinate system
 		self.attribute_list = []  # attribute list of the input shapefile. all attribute names will be in upper class
 		self.con = None # sqlite connection object
 		self.cur = None
@@ -80,6 +505,12 @@ class Determine_project_id:
 		self.geo_calc_proj_id = {} # geographically matching projectid. eg. {'cc1': None, ... 'cc5': 'TIM-Gil01', 'cc6': 'TIM-Gil01', 'cc7': 'TIM-Gil01', ... 'cc11': None,...}
 		self.uniq_id_to_proj_id = {} # final project ids eg. {'cc1': 'TIM-GIL01', 'cc2': 'TIM-GIL01', 'cc3': 'TIM-Gil01', 'cc4': 'TIM-Gil01', ...., 'cc10': 'NOR-HWY11-5',..., 'sh1': 'TIM-Gil01'}
 		self.summary_dict = {} # eg. {'TestProj-01': 1, 'FUS49': 4, -1: 0}
+		self.projects = [] # project ids and polygons (WKB) in the shapefile's order eg. [['TIM-Gil01', b'\x01\x03\x00...'],...]
+		self.prepared_projects = {} # made once per engine by get_prepared_projects. eg. {'ogr': [['TIM-Gil01', <ogr Geometry>, [minx, miny, maxx, maxy]],...]}
+		self.geo_cache_db = None
+		self.shp_version = None # sha256 of the project ids and polygons. see get_shp_version
+		self.gps_buffers = None # buffered projects. see get_gps_buffers. eg. [['TIM-Gil01', b'\x01\x03\x00...'],...]
+		self.nearest_proj = {} # nearest project and distance (m) of the clusters that are outside of every project polygon. eg. {'cc1': ['TIM-Gil01', 35.2], 'cc11': None,...}
 
 		self.logger.info('\n')
 		self.logger.info('--> Running determine_project_id module')
@@ -101,28 +532,23 @@ class Determine_project_id:
 	def check_shpfile(self):
 		"""
 		Check...
-		1. if the shapefile exists. 
+		1. if the shapefile has been loaded to the sqlite database.
 		2. if the ProjectID field exists.
 		3. if the shapefile is in geographic projection
+		The shapefile itself is not opened here - shp2sqlite (or its cache) has saved its field names and spatial reference in the info table.
 		"""
-		driver = ogr.GetDriverByName('ESRI Shapefile')
-		self.dataSource = driver.Open(self.prj_shpfile, 0) # 0 means read-only. 1 means writeable.
-
-		# Check to see if shapefile is found.
-		if self.dataSource is None:
-		    self.logger.info('Could not open %s' % (self.prj_shpfile))
-		else:
-		    self.logger.info('Opened %s' % (self.prj_shpfile))
-		    self.layer = self.dataSource.GetLayer()
-		    self.layer_featureCount = self.layer.GetFeatureCount()
-		    self.logger.debug("Number of features in %s: %d" % (os.path.basename(self.prj_shpfile),self.layer_featureCount))
-
+		self.initiate_connection()
+		if self.cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (self.shp_info_tablename,)).fetchone()[0] == 0:
+			self.close_connection()
+			self.logger.info('Could not find %s in the sqlite database. shp2sqlite must run first.'%self.shp_info_tablename)
+			raise Exception('%s table not found'%self.shp_info_tablename)
+		attr_names, self.layer_featureCount, self.spatialRef, is_geographic = self.cur.execute(
+			"SELECT attr_names, rec_count, spatial_ref, is_geographic FROM %s"%self.shp_info_tablename).fetchone()
+		self.close_connection()
+		self.logger.debug("Number of features in %s: %d" % (os.path.basename(self.prj_shpfile),self.layer_featureCount))
 
 		# checking if the shapefile has ProjectID field
-		layer_def = self.layer.GetLayerDefn()
-		for n in range(layer_def.GetFieldCount()):
-			field_def = layer_def.GetFieldDefn(n)
-			self.attribute_list.append(field_def.name.upper())
+		self.attribute_list = json.loads(attr_names)
 		self.logger.debug('List of attributes found in %s:\n%s'%(os.path.basename(self.prj_shpfile),self.attribute_list))
 
 		if self.prjID_field.upper() in self.attribute_list:
@@ -133,12 +559,27 @@ class Determine_project_id:
 
 
 		# Check to see if shapefile is in geographic coordinates
-		self.spatialRef = self.layer.GetSpatialRef()
-		if not self.spatialRef.IsGeographic():
-			self.logger.info('This is not geographic \nMake sure your shapefile is in WGS84')
-			raise Exception('Make sure your shapefile is in WGS84 geographic coordinates')
-		else:
+		# if it's in projected coordinates (eg. MNR Lambert), the cluster points are reprojected to the shapefile's coordinate system (see to_layer_coords).
+		# that needs osr (GDAL), so without osgeo the shapefile must still be in geographic coordinates.
+		if is_geographic:
 			self.logger.debug('The shapefile is in geographic coordinates')
+		elif osr == None:
+			self.logger.info('This is not geographic and osgeo (GDAL) is not installed to reproject the cluster points.\nMake sure your shapefile is in WGS84')
+			raise Exception('Make sure your shapefile is in WGS84 geographic coordinates (or install osgeo)')
+		else:
+			wgs84 = osr.SpatialReference()
+			wgs84.ImportFromEPSG(4326)
+			layer_srs = osr.SpatialReference()
+			if self.spatialRef in [None, ''] or layer_srs.ImportFromWkt(self.spatialRef) != 0:
+				self.logger.info('The spatial reference of the shapefile is missing or can not be read (check the .prj file)')
+				raise Exception('Make sure your shapefile has a valid spatial reference')
+			# GDAL 3 uses lat, lon order for EPSG:4326 unless we ask for the traditional lon, lat (x, y) order.
+			if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+				wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+				layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+			self.to_layer_transform = osr.CoordinateTransformation(wgs84, layer_srs)
+			self.layer_units_m = layer_srs.GetLinearUnits()
+			self.logger.info('The shapefile is in projected coordinates (%s). The cluster points will be reprojected to it.'%layer_srs.GetAttrValue('PROJCS'))
 
 
 
@@ -153,10 +594,15 @@ class Determine_project_id:
 		# Create 'geo check' field and 'final project id' field for both tables
 		# 'geo check' field will be used when intersecting each cluster points to the 
 		# project boundaries to determine the record's project ID geographically
+		# the nearest project fields are only filled out for the clusters that are outside of every project polygon.
+		new_fields = {self.geo_check_field: 'CHAR', self.fin_proj_id_field: 'CHAR'}
+		if self.nearest_project_fallback:
+			new_fields[self.nearest_proj_field] = 'CHAR'
+			new_fields[self.nearest_dist_field] = 'REAL'
 		for table in [self.clearcut_tbl_name, self.shelterwood_tbl_name]:
-			for f in [self.geo_check_field, self.fin_proj_id_field]:
+			for f, field_type in new_fields.items():
 				if f.upper() not in [i.upper() for i in self.tablenames_n_rec_count[table][0]]:
-					add_field_sql = "ALTER TABLE %s ADD %s CHAR;"%(table,f)
+					add_field_sql = "ALTER TABLE %s ADD %s %s;"%(table,f,field_type)
 					self.logger.debug(add_field_sql)
 					self.cur.execute(add_field_sql)
 					# also update the tablenames_n_rec_count
@@ -180,19 +626,21 @@ class Determine_project_id:
 
 		# Clearcut
 		# select_sql = "SELECT unique_id, latitude, longitude FROM CLEARCUT_SURVEY_V2021"
-		select_sql = "SELECT %s, latitude, longitude FROM %s"%(self.unique_id_field, self.clearcut_tbl_name)
+		select_sql = "SELECT %s, IFNULL(CAST(latitude AS REAL), 0), IFNULL(CAST(longitude AS REAL), 0) FROM %s"%(self.unique_id_field, self.clearcut_tbl_name)
 		self.logger.debug(select_sql)
 		# run select query to grab coordinates and the unique ids
 		# Note that starting Dec 2020, if the user have not collected lat long, the X, Y value will be blank instead of 0, 0.
-		self.clearcut_coords = {int(row[0]): [float(row[1] or 0),float(row[2] or 0)] for row in self.cur.execute(select_sql)} # eg. {1: [48.50010352, -81.18260821], 2: [48.50010352, -81.18215905],..} where the keys are the unique ids.
+		# the CAST in the query turns the blank values into 0. (with typed columns from csv2sqlite, latitude and longitude are already stored as REAL)
+		self.clearcut_coords = {row[0]: [row[1],row[2]] for row in self.cur.execute(select_sql)} # eg. {1: [48.50010352, -81.18260821], 2: [48.50010352, -81.18215905],..} where the keys are the unique ids.
 
 		# Shelterwood
 		# select_sql = "SELECT unique_id, latitude, longitude FROM SHELTERWOOD_SURVEY_V2021"
-		select_sql = "SELECT %s, latitude, longitude FROM %s"%(self.unique_id_field, self.shelterwood_tbl_name)
+		select_sql = "SELECT %s, IFNULL(CAST(latitude AS REAL), 0), IFNULL(CAST(longitude AS REAL), 0) FROM %s"%(self.unique_id_field, self.shelterwood_tbl_name)
 		self.logger.debug(select_sql)
 		# run select query to grab coordinates and the unique ids
 		# Note that starting Dec 2020, if the user have not collected lat long, the X, Y value will be blank instead of 0, 0.
-		self.shelterwood_coords = {int(row[0]): [float(row[1] or 0),float(row[2] or 0)] for row in self.cur.execute(select_sql)} # eg. {1: [48.50010352, -81.18260821], 2: [48.50010352, -81.18215905],..} where the keys are the unique ids.
+		# the CAST in the query turns the blank values into 0. (with typed columns from csv2sqlite, latitude and longitude are already stored as REAL)
+		self.shelterwood_coords = {row[0]: [row[1],row[2]] for row in self.cur.execute(select_sql)} # eg. {1: [48.50010352, -81.18260821], 2: [48.50010352, -81.18215905],..} where the keys are the unique ids.
 
 		self.logger.debug("Clearcut Coordinates: %s"%self.clearcut_coords)
 		self.logger.debug("Shelterwood Coordinates: %s"%self.shelterwood_coords)
@@ -215,16 +663,16 @@ class Determine_project_id:
 		select_sql = "SELECT %s, %s, %s FROM %s"%(self.unique_id_field, self.proj_id_override, self.user_spec_proj_id_field, self.clearcut_tbl_name)
 		self.logger.debug(select_sql)
 		# run select query
-		cc_override_dict = {int(row[0]): str(row[1]) for row in self.cur.execute(select_sql)} # eg. {1: 'Use GPS', 2: 'Use GPS', 3: 'TestPrj-01',...}
-		cc_user_spec_proj_id = {int(row[0]): str(row[2]) for row in self.cur.execute(select_sql)} 
+		cc_override_dict = {row[0]: str(row[1]) for row in self.cur.execute(select_sql)} # eg. {1: 'Use GPS', 2: 'Use GPS', 3: 'TestPrj-01',...}
+		cc_user_spec_proj_id = {row[0]: str(row[2]) for row in self.cur.execute(select_sql)} 
 
 		# Shelterwood
 		# select_sql = "SELECT unique_id, prj_id_override, ProjectID02 FROM SHELTERWOOD_SURVEY_V2021"
 		select_sql = "SELECT %s, %s, %s FROM %s"%(self.unique_id_field, self.proj_id_override, self.user_spec_proj_id_field, self.shelterwood_tbl_name)
 		self.logger.debug(select_sql)
 		# run select query
-		sh_override_dict = {int(row[0]): str(row[1]) for row in self.cur.execute(select_sql)} # eg. {1: 'Use GPS', 2: 'Use GPS', 3: 'TestPrj-01',...}
-		sh_user_spec_proj_id = {int(row[0]): str(row[2]) for row in self.cur.execute(select_sql)} 
+		sh_override_dict = {row[0]: str(row[1]) for row in self.cur.execute(select_sql)} # eg. {1: 'Use GPS', 2: 'Use GPS', 3: 'TestPrj-01',...}
+		sh_user_spec_proj_id = {row[0]: str(row[2]) for row in self.cur.execute(select_sql)} 
 
 		self.close_connection()
 
@@ -251,36 +699,47 @@ class Determine_project_id:
 		"""
 		self.logger.info('Running determine_project_id module to geographically check the projectid')
 
-		# get a list of the features in the shapefile.
-		projects = [self.layer.GetFeature(i) for i in range(self.layer_featureCount)] # a list of ogr's feature objects https://gdal.org/python/osgeo.ogr.Feature-class.html
-		# self.logger.debug('%s\n%s\n%s\n%s\n'%(projects[0].items(),projects[0].geometry(),projects[0].keys(),projects[0].GetField(1)))
+		self.load_projects()
 
-		# iterate through Clearcut and Shelterwood coordinates
+		# Clearcut and Shelterwood coordinates. eg. [['cc1', -81.18260821, 48.50010352], ['cc2', -81.18215905, 48.50010352],...]
+		points = []
 		for silvsys, coordinates in {'cc':self.clearcut_coords, 'sh':self.shelterwood_coords}.items():
 			for uniq_id, coord in coordinates.items():
-				# create point geometry object
-				lat = coord[0]
-				lon = coord[1]
-				pt = ogr.Geometry(ogr.wkbPoint)
-				pt.AddPoint(lon, lat) # long, lat is apparently the default setting.
-
-				# iterate through project polygon shapes
-				matching_proj_id = None
-				for proj in projects:
-					# Within is the method that checks if point a is within point b.
-					if pt.Within(proj.geometry()):
-						matching_proj_id = proj.items()[self.prjID_field] # proj.items() should give you something like {'Id': 2, 'ProjectID': '2'}
-						# if you get error here, it's because your ProjectID field in the shp file doesn't match with the one in config file (project_id_fieldname).
-						break
-
-				self.geo_calc_proj_id[silvsys + str(uniq_id)] = matching_proj_id # {cc1: 'FUS49', cc2: None,...}
-
-				# delete the point geometry object
-				del pt
+				points.append([silvsys + str(uniq_id), coord[1], coord[0]]) # long, lat
+		# the same points in the shapefile's coordinate system (the same as points if the shapefile is in geographic coordinates)
+		layer_points = self.to_layer_coords(points)
+		self.save_cluster_points(points, layer_points)
+
+		# the points that were matched in an earlier run (against the same polygons) don't need to be matched again
+		cached = self.check_geo_cache(points) if self.reuse_geo_matches else {} # eg. {0: 12, 1: None, 5: 12,...} position in points: matching project
+		to_match = [point for n, point in enumerate(layer_points) if n not in cached]
+		new_matches = iter(self.match_points(to_match) if len(to_match) > 0 else [])
+		matches = [cached[n] if n in cached else next(new_matches) for n in range(len(points))]
+		if self.reuse_geo_matches:
+			self.update_geo_cache(points, matches)
+
+		# second pass: the points that missed every polygon by less than the GPS tolerance
+		if self.gps_tolerance_m > 0:
+			missed = [n for n, match in enumerate(matches) if match == None]
+			if len(missed) > 0:
+				tolerance_matches = self.match_within_tolerance([layer_points[n] for n in missed])
+				for n, match in zip(missed, tolerance_matches):
+					if match != None:
+						self.logger.debug("%s is within %s m of %s"%(points[n][0], self.gps_tolerance_m, self.projects[match][0]))
+						matches[n] = match
+				self.logger.info("%s of %s unmatched cluster points are within the GPS tolerance (%s m) of a project polygon"%(
+					len([match for match in tolerance_matches if match != None]), len(missed), self.gps_tolerance_m))
+
+		for point, match in zip(points, matches):
+			self.geo_calc_proj_id[point[0]] = self.projects[match][0] if match != None else None # {cc1: 'FUS49', cc2: None,...}
 
 		self.logger.debug("geo_calc_proj_id = %s"%self.geo_calc_proj_id)
 		# geo_calc_proj_id = {'cc1': None, ... 'cc5': 'TIM-Gil01', 'cc6': 'TIM-Gil01', 'cc7': 'TIM-Gil01', ... 'cc11': None,...}
 
+		if self.nearest_project_fallback:
+			unmatched = [n for n, match in enumerate(matches) if match == None]
+			self.find_nearest_projects([points[n] for n in unmatched], [layer_points[n] for n in unmatched])
+
 
 		# now that we have all 3 ProjectID info (geo_calc_proj_id, user_spec_proj_id, and override_dict), we can decide the final projectID
 		self.logger.info("Determining final ProjectID")
@@ -308,6 +767,286 @@ class Determine_project_id:
 		# uniq_id_to_proj_id eg. {'cc1': 'TIM-GIL01', 'cc2': 'TIM-GIL01', 'cc3': 'TIM-Gil01', 'cc4': 'TIM-Gil01', ...., 'cc10': 'NOR-HWY11-5',..., 'sh1': 'TIM-Gil01'}
 
 	
+	def to_layer_coords(self, points):
+		"""
+		puts the points ([[key, lon, lat],...]) in the shapefile's coordinate system so they can be matched to the project polygons as they are.
+		all the points are transformed at once with one TransformPoints call. the polygons are never reprojected.
+		if the shapefile is in geographic coordinates, the points are returned as they are.
+		"""
+		if self.to_layer_transform == None or len(points) == 0:
+			return points
+		transformed = self.to_layer_transform.TransformPoints([[lon, lat] for key, lon, lat in points])
+		return [[point[0], xyz[0], xyz[1]] for point, xyz in zip(points, transformed)]
+
+
+	def load_projects(self):
+		"""
+		get a list of the project ids and polygons in the shapefile (in the shapefile's order) from the shp2sqlite table.
+		"""
+		self.initiate_connection()
+		select_sql = "SELECT %s, %s FROM %s ORDER BY rowid"%(self.prjID_field, self.shp_geom_field, self.shp2sqlite_tablename)
+		self.logger.debug(select_sql)
+		# if you get error here, it's because your ProjectID field in the shp file doesn't match with the one in config file (project_id_fieldname).
+		self.projects = [[proj_id if proj_id != '' else None, wkb] for proj_id, wkb in self.cur.execute(select_sql)] # eg. [['TIM-Gil01', b'\\x01\\x03\\x00...'],...]
+		self.close_connection()
+		self.prepared_projects = {}
+
+
+	def get_prepared_projects(self, engine):
+		"""
+		prepared projects (see prepare_projects) of self.projects for the engine ('ogr' or 'numpy').
+		they are made only once per run.
+		"""
+		if engine not in self.prepared_projects:
+			self.prepared_projects[engine] = prepare_projects(self.projects, engine)
+		return self.prepared_projects[engine]
+
+
+	def match_points(self, points):
+		"""
+		matches the points ([[key, lon, lat],...]) to the project polygons with the engine and the number of workers from the config file.
+		returns a list with the index of the matching project in self.projects (or None) for each point.
+		"""
+		engine = 'numpy' if self.geo_engine == 'numpy' or ogr == None else 'ogr'
+		if engine == 'numpy':
+			try:
+				self.get_prepared_projects('numpy')
+			except ValueError as e:
+				if ogr == None:
+					raise
+				self.logger.info("!!!! The numpy engine can't read the project polygons (%s). Using OGR instead."%e)
+				engine = 'ogr'
+
+		if self.geo_workers > 1:
+			return self.geo_match_parallel(points, engine)
+		elif engine == 'numpy':
+			return self.geo_match_numpy(points)
+		else:
+			return self.geo_match_ogr(points)
+
+
+	def get_shp_version(self):
+		"""
+		sha256 of the project ids and polygons (WKB) in the shapefile's order, and of the project id field name.
+		it changes whenever the boundaries (or the project ids) change.
+		"""
+		if self.shp_version == None:
+			sha = hashlib.sha256(self.prjID_field.upper().encode())
+			for proj_id, wkb in self.projects:
+				sha.update(repr(proj_id).encode())
+				sha.update(wkb if wkb != None else b'')
+			self.shp_version = sha.hexdigest()
+		return self.shp_version
+
+
+	def check_geo_cache(self, points):
+		"""
+		looks up the points in the geo match cache (geo_match_cache.sqlite in the cache folder).
+		the cache keeps the matching project of each (rounded) lat, lon from the earlier runs, for one version of the shapefile (see get_shp_version).
+		if the shapefile has changed, the old matches are deleted.
+		returns {position in points: index of the matching project or None} for the points found in the cache.
+		"""
+		self.geo_cache_db = os.path.join(self.cache_folderpath, 'geo_match_cache.sqlite')
+		shp_version = self.get_shp_version()
+		con = sqlite3.connect(self.geo_cache_db, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("""CREATE TABLE IF NOT EXISTS geo_matches (shp_version TEXT, lat REAL, lon REAL, proj_index INTEGER, proj_id TEXT,
+			PRIMARY KEY (shp_version, lat, lon))""")
+		if cur.execute("SELECT COUNT(*) FROM geo_matches WHERE shp_version != ?", (shp_version,)).fetchone()[0] > 0:
+			self.logger.info("The project boundaries have changed since the last run. Deleting the old geo matches from the cache.")
+			cur.execute("DELETE FROM geo_matches WHERE shp_version != ?", (shp_version,))
+		known = {(lat, lon): proj_index for lat, lon, proj_index in cur.execute("SELECT lat, lon, proj_index FROM geo_matches WHERE shp_version = ?", (shp_version,))}
+		con.close()
+
+		cached = {}
+		for n, (key, lon, lat) in enumerate(points):
+			rounded = (round(lat, self.geo_cache_decimals), round(lon, self.geo_cache_decimals))
+			if rounded in known:
+				cached[n] = known[rounded]
+		self.logger.info("%s of %s cluster points found in the geo match cache"%(len(cached), len(points)))
+		return cached
+
+
+	def update_geo_cache(self, points, matches):
+		"""
+		saves the matching project of every point in the geo match cache (see check_geo_cache).
+		"""
+		shp_version = self.get_shp_version()
+		rows = {}
+		for (key, lon, lat), match in zip(points, matches):
+			rounded = (round(lat, self.geo_cache_decimals), round(lon, self.geo_cache_decimals))
+			rows[rounded] = [shp_version, rounded[0], rounded[1], match, self.projects[match][0] if match != None else None]
+		con = sqlite3.connect(self.geo_cache_db, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("BEGIN")
+		cur.executemany("INSERT OR REPLACE INTO geo_matches VALUES (?,?,?,?,?)", rows.values())
+		cur.execute("COMMIT")
+		con.close()
+
+
+	def get_gps_buffers(self):
+		"""
+		the buffered project polygons (see buffer_projects) for gps_tolerance_m.
+		they are made once per shapefile version and tolerance and kept in the cache folder (gps_buffers table of geo_match_cache.sqlite),
+		so they're only made again when the project polygons or the tolerance change.
+		"""
+		if self.gps_buffers != None:
+			return self.gps_buffers
+		shp_version = self.get_shp_version()
+		con = sqlite3.connect(os.path.join(self.cache_folderpath, 'geo_match_cache.sqlite'), isolation_level = None)
+		cur = con.cursor()
+		cur.execute("""CREATE TABLE IF NOT EXISTS gps_buffers (shp_version TEXT, tolerance_m REAL, proj_index INTEGER, proj_id TEXT, buffer_wkb BLOB,
+			PRIMARY KEY (shp_version, tolerance_m, proj_index))""")
+		cur.execute("BEGIN")
+		cur.execute("DELETE FROM gps_buffers WHERE shp_version != ? OR tolerance_m != ?", (shp_version, self.gps_tolerance_m))
+		rows = cur.execute("SELECT proj_id, buffer_wkb FROM gps_buffers ORDER BY proj_index").fetchall()
+		if len(rows) == len(self.projects):
+			self.logger.info("Using the buffered project polygons (%s m) from the cache"%self.gps_tolerance_m)
+			self.gps_buffers = [[proj_id, wkb] for proj_id, wkb in rows]
+		else:
+			self.logger.info("Buffering the project polygons by %s m"%self.gps_tolerance_m)
+			self.gps_buffers = buffer_projects(self.projects, self.gps_tolerance_m, self.layer_units_m)
+			cur.execute("DELETE FROM gps_buffers")
+			cur.executemany("INSERT INTO gps_buffers VALUES (?,?,?,?,?)",
+				([shp_version, self.gps_tolerance_m, n, proj_id, wkb] for n, (proj_id, wkb) in enumerate(self.gps_buffers)))
+		cur.execute("COMMIT")
+		con.close()
+		return self.gps_buffers
+
+
+	def match_within_tolerance(self, points):
+		"""
+		matches the points that are outside of every project polygon against the buffered polygons (see get_gps_buffers),
+		with the same engine as match_points. a point within the tolerance of more than one polygon gets the first one (in the shapefile's order).
+		without OGR the buffers can't be made, so the distance to the polygons' boundaries is checked instead (see match_points_within_distance).
+		returns a list with the index of the matching project in self.projects (or None) for each point.
+		"""
+		if ogr == None:
+			return match_points_within_distance(points, self.get_prepared_projects('numpy'), self.gps_tolerance_m, self.layer_units_m)
+		buffers = self.get_gps_buffers()
+		if self.geo_engine == 'numpy':
+			try:
+				return match_points_numpy(points, prepare_projects(buffers, 'numpy'))
+			except ValueError as e:
+				self.logger.info("!!!! The numpy engine can't read the buffered polygons (%s). Using OGR instead."%e)
+		return match_points_ogr(points, prepare_projects(buffers, 'ogr'))
+
+
+	def save_cluster_points(self, points, layer_points):
+		"""
+		writes the coordinates of every cluster into the cluster points table (eg. cluster_points) as REAL numbers.
+		silvsys ('CC' or 'SH') and unique_id point to the record in the clearcut or shelterwood survey table.
+		lon, lat are the GPS coordinates and x, y are the same point in the shapefile's coordinate system (the same as lon, lat if the shapefile is geographic),
+		so the table can be joined straight to the R*Tree of the project boxes (see get_rtree_candidates and the example in shp2sqlite).
+		the clusters without GPS coordinates get NULL (instead of 0, 0).
+		"""
+		rows = []
+		for (key, lon, lat), (layer_key, x, y) in zip(points, layer_points):
+			if lon == 0 and lat == 0:
+				lon, lat, x, y = None, None, None, None
+			rows.append([key[:2].upper(), int(key[2:]), lon, lat, x, y])
+
+		self.initiate_connection()
+		self.cur.execute("DROP TABLE IF EXISTS %s"%self.cluster_points_tblname)
+		self.cur.execute("CREATE TABLE %s (silvsys TEXT, unique_id INTEGER, lon REAL, lat REAL, x REAL, y REAL, PRIMARY KEY (silvsys, unique_id))"%self.cluster_points_tblname)
+		self.cur.executemany("INSERT INTO %s VALUES (?,?,?,?,?,?)"%self.cluster_points_tblname, rows)
+		self.close_connection()
+		self.tablenames_n_rec_count[self.cluster_points_tblname] = [['silvsys', 'unique_id', 'lon', 'lat', 'x', 'y'], len(rows)]
+		self.logger.debug("%s cluster points written to %s"%(len(rows), self.cluster_points_tblname))
+
+
+	def get_rtree_candidates(self, points):
+		"""
+		finds the candidate projects of every point with one sql join of the cluster points table (see save_cluster_points)
+		and the R*Tree of the project bounding boxes (see shp2sqlite).
+		points: [[key, x, y],...] (the keys are looked up in the cluster points table, eg. 'cc12' -> silvsys = 'CC', unique_id = 12)
+		returns a list with the indices of the candidate projects (in the shapefile's order) for each point,
+		or None if the R*Tree table is not in the database.
+		"""
+		self.initiate_connection()
+		if self.cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?", (self.shp_rtree_tablename,)).fetchone()[0] == 0:
+			self.close_connection()
+			self.logger.debug("%s not found. Using Envelope_tree instead."%self.shp_rtree_tablename)
+			return None
+
+		# rowid of the shp2sqlite table -> index in the shapefile's order
+		rowid_to_index = {row[0]: n for n, row in enumerate(self.cur.execute("SELECT rowid FROM %s ORDER BY rowid"%self.shp2sqlite_tablename))}
+		positions = {(point[0][:2].upper(), int(point[0][2:])): n for n, point in enumerate(points)} # eg. {('CC', 12): 0,...}
+		select_sql = """SELECT c.silvsys, c.unique_id, r.id FROM %s c JOIN %s r
+			ON r.minx <= c.x AND r.maxx >= c.x AND r.miny <= c.y AND r.maxy >= c.y ORDER BY r.id"""%(self.cluster_points_tblname, self.shp_rtree_tablename)
+		self.logger.debug(select_sql)
+		candidates = [[] for point in points]
+		for silvsys, uniq_id, rtree_id in self.cur.execute(select_sql):
+			if (silvsys, uniq_id) in positions: # the points that were found in the geo match cache are not matched again
+				candidates[positions[(silvsys, uniq_id)]].append(rowid_to_index[rtree_id])
+		self.close_connection()
+		return candidates
+
+
+	def geo_match_ogr(self, points):
+		"""
+		finds the first project polygon (in the shapefile's order) that each point is within, using OGR.
+		points: [[key, lon, lat],...]
+		returns a list with the index of the matching project in self.projects (or None) for each point.
+		"""
+		# candidate projects of each point from the R*Tree.
+		# the R*Tree keeps the boxes in 32-bit floats rounded outwards, so a candidate list may have a few extra projects but never misses one.
+		return match_points_ogr(points, self.get_prepared_projects('ogr'), self.get_rtree_candidates(points))
+
+
+	def geo_match_numpy(self, points):
+		"""
+		same as geo_match_ogr but without OGR (see match_points_numpy).
+		raises ValueError if a polygon can't be read (see wkb_to_rings).
+		"""
+		return match_points_numpy(points, self.get_prepared_projects('numpy'))
+
+
+	def geo_match_parallel(self, points, engine):
+		"""
+		same as geo_match_ogr or geo_match_numpy, but the points are split into shards that are matched by geo_workers processes.
+		each process prepares its own copy of the project polygons (see geo_match_worker_init).
+		the shards are in the same order as the points and pool.map gives the results back in that order, so the result is the same as the serial one.
+		"""
+		num_shards = min(len(points), self.geo_workers * 4)
+		shard_size = math.ceil(len(points) / num_shards)
+		shards = [points[start:start + shard_size] for start in range(0, len(points), shard_size)]
+		self.logger.info("Matching %s points in %s shards with %s worker processes (%s engine)"%(len(points), len(shards), self.geo_workers, engine))
+		with multiprocessing.Pool(self.geo_workers, initializer = geo_match_worker_init, initargs = (self.projects, engine)) as pool:
+			results = pool.map(geo_match_worker, shards)
+		return [match for shard_result in results for match in shard_result]
+
+
+
+	def find_nearest_projects(self, points, layer_points):
+		"""
+		for the cluster points that are outside of every project polygon, finds the nearest project and the distance to it in metres (see nearest_projects).
+		points: [[key, lon, lat],...] layer_points: the same points in the shapefile's coordinate system (see to_layer_coords)
+		the clusters without GPS coordinates (0, 0) are skipped.
+		the results go to self.nearest_proj and to the log, so they can be looked up without opening the shapefile.
+		"""
+		if len(points) == 0:
+			return
+		with_gps = [layer_point for point, layer_point in zip(points, layer_points) if not (point[1] == 0 and point[2] == 0)]
+		try:
+			nearest = nearest_projects(with_gps, self.get_prepared_projects('numpy'), self.layer_units_m) if len(with_gps) > 0 else []
+		except ValueError as e:
+			self.logger.info("!!!! Could not find the nearest projects of the unmatched clusters (%s)"%e)
+			return
+		for point, result in zip(with_gps, nearest):
+			self.nearest_proj[point[0]] = [self.projects[result[0]][0], round(result[1], 1)] if result != None else None
+
+		self.logger.info("!!!! WARNING: %s cluster points are outside of every project polygon !!!!"%len(points))
+		for key, lon, lat in points:
+			if key not in self.nearest_proj:
+				self.logger.info("!!!! %s: no GPS coordinates"%key)
+			elif self.nearest_proj[key] == None:
+				self.logger.info("!!!! %s (lat %s, lon %s): no project polygon found"%(key, lat, lon))
+			else:
+				self.logger.info("!!!! %s (lat %s, lon %s): nearest project = %s, distance = %s m"%(key, lat, lon, self.nearest_proj[key][0], self.nearest_proj[key][1]))
+
+
+
 	def check_results(self):
 		# get list of projects from the sqlite projects_shp and see if that list matches with the project ids we have in uniq_id_to_proj_id
 		
@@ -395,27 +1134,34 @@ class Determine_project_id:
 			UPDATE l387081_Cluster_Survey_Testing_
 			SET geo_proj_id = 'FUS49', fin_proj_id = 'TestProj-01'
 			WHERE unique_id = 1
+		the values are sent as parameters with one executemany per table, and both tables are updated in one transaction.
+		unique_id is the integer primary key of the survey tables, so each UPDATE finds its record without a table scan.
 		"""
 		self.logger.info('Populating (Updating) SQLite geo_check field with ProjectIDs')
 		self.initiate_connection()
 
+		set_fields = [self.geo_check_field, self.fin_proj_id_field]
+		if self.nearest_project_fallback:
+			set_fields += [self.nearest_proj_field, self.nearest_dist_field]
+
+		# eg. {'CC': [['FUS49', 'TestProj-01', 1], ['', 'TIM-Gil01', 2],...], 'SH': [...]}
+		params = {'CC': [], 'SH': []}
 		for uniq_id, proj_id in self.uniq_id_to_proj_id.items():
 			silvsys = uniq_id[:2].upper()
 			geo_proj_id = '' if self.geo_calc_proj_id[uniq_id] == None else self.geo_calc_proj_id[uniq_id]
 			final_proj_id = '' if proj_id == None else proj_id
-
-			if silvsys == "CC":
-				# eg. UPDATE Clearcut_Survey_v2021 SET geo_proj_id = 'value', fin_proj_id = 'value' WHERE unique_id = 12
-				update_sql = "UPDATE %s SET %s = '%s', %s = '%s' WHERE %s = %s"%(self.clearcut_tbl_name, self.geo_check_field, 
-					geo_proj_id, self.fin_proj_id_field, final_proj_id, self.unique_id_field, uniq_id[2:])
-				self.logger.debug(update_sql)
-				self.cur.execute(update_sql)
-			else:
-				# eg. UPDATE Shelterwood_Survey_v2021 SET geo_proj_id = 'value', fin_proj_id = 'value' WHERE unique_id = 12
-				update_sql = "UPDATE %s SET %s = '%s', %s = '%s' WHERE %s = %s"%(self.shelterwood_tbl_name, self.geo_check_field, 
-					geo_proj_id, self.fin_proj_id_field, final_proj_id, self.unique_id_field, uniq_id[2:])
-				self.logger.debug(update_sql)
-				self.cur.execute(update_sql)				
+			values = [geo_proj_id, final_proj_id]
+			if self.nearest_project_fallback:
+				nearest = self.nearest_proj.get(uniq_id)
+				values += ['', None] if nearest == None else nearest # eg. ['TIM-Gil01', 35.2]
+			params[silvsys].append(values + [int(uniq_id[2:])])
+
+		# the first UPDATE starts the transaction and close_connection commits it.
+		for silvsys, table in {'CC': self.clearcut_tbl_name, 'SH': self.shelterwood_tbl_name}.items():
+			# eg. UPDATE Clearcut_Survey_v2022 SET geo_proj_id = ?, fin_proj_id = ? WHERE unique_id = ?
+			update_sql = "UPDATE %s SET %s WHERE %s = ?"%(table, ', '.join(['%s = ?'%f for f in set_fields]), self.unique_id_field)
+			self.logger.debug("%s (%s records)"%(update_sql, len(params[silvsys])))
+			self.cur.executemany(update_sql, params[silvsys])
 
 		self.close_connection()
 
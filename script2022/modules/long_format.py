@@ -0,0 +1,149 @@
+# the purpose of this script is to add two long-format (normalized) tables to the sqlite database right after csv2sqlite.
+# The survey tables are very wide: Species1SpeciesNamePlot1 ~ Species6SpeciesNamePlot8, Species1NumberofTreesPlot1 ~ Species6NumberofTreesPlot8,
+# UnoccupiedPlot1 ~ UnoccupiedPlot8 and so on. The same data is written here as one row per species entry and one row per plot,
+# so that it can be summarized with (indexed) sql instead of looping through hundreds of dictionary keys per cluster.
+#
+# survey_trees: silvsys, cluster_uid, plot, slot, plot_area, species_code, species_name, count
+#		one row for each species entered (eg. Species2SpeciesNamePlot3 = 'Bf (fir, balsam)' and Species2NumberofTreesPlot3 = 4
+#		becomes 'CC', 12, 3, 2, 8, 'BF', 'Bf (fir, balsam)', 4)
+#		plot_area (sqm): clearcut 8 (4 if PlotSize = '4 sqm'), shelterwood 8 for species 1~3 and 16 for species 4~6
+#		the species codes are not checked against SpeciesGroup.csv here. the entries in the unoccupied plots are kept as well.
+# survey_plots: silvsys, cluster_uid, plot, unoccupied, unoccupied_reason, comments, photos, num_trees
+#
+# cluster_uid is the unique_id of the survey table, so silvsys ('CC' or 'SH') is needed to tell the clearcut and shelterwood clusters apart.
+
+
+import sqlite3
+
+# importing custom modules
+if __name__ == '__main__':
+	import common_functions
+else:
+	from modules import common_functions
+
+
+class Long_format:
+	"""
+	Use 'run_all' method to run all the methods at once.
+	"""
+	def __init__(self, cfg_dict, db_filepath, tablenames_n_rec_count, logger):
+
+		# static variables from the config file:
+		self.unique_id_field = cfg_dict['SQLITE']['unique_id_fieldname']
+		self.trees_tblname = cfg_dict['SQLITE']['trees_tblname']
+		self.plots_tblname = cfg_dict['SQLITE']['plots_tblname']
+		self.num_of_plots = int(cfg_dict['CALC']['num_of_plots'])
+		self.num_of_spc_slots = 6 # Species1 ~ Species6 for each plot
+
+		# other static and non-static variables that brought into this class:
+		self.db_filepath = db_filepath
+		self.tablenames_n_rec_count = tablenames_n_rec_count # eg. {'Clearcut_Survey_v2022': [['ClusterNumber', 'ProjectID', ...],2], 'Shelterwood_Survey_v2022': [['ClusterNumber', 'ProjectID', ...],2]}
+		self.logger = logger
+		self.survey_tbl_names = {'CC': 'Clearcut_Survey_v2022', 'SH': 'Shelterwood_Survey_v2022'}
+
+		self.con = None
+		self.cur = None
+
+		self.logger.info('\n')
+		self.logger.info('--> Running long_format module')
+
+
+	def create_tables(self):
+		"""
+		(re)creates empty survey_trees and survey_plots tables.
+		"""
+		self.cur.execute("DROP TABLE IF EXISTS %s"%self.trees_tblname)
+		self.cur.execute("DROP TABLE IF EXISTS %s"%self.plots_tblname)
+		self.cur.execute("""CREATE TABLE %s (silvsys TEXT, cluster_uid INTEGER, plot INTEGER, slot INTEGER, plot_area INTEGER,
+			species_code TEXT, species_name TEXT, count INTEGER)"""%self.trees_tblname)
+		self.cur.execute("""CREATE TABLE %s (silvsys TEXT, cluster_uid INTEGER, plot INTEGER, unoccupied TEXT, unoccupied_reason TEXT,
+			comments TEXT, photos TEXT, num_trees INTEGER, PRIMARY KEY (silvsys, cluster_uid, plot))"""%self.plots_tblname)
+
+
+	def fill_tables(self):
+		"""
+		un-pivots each survey table with one INSERT ... SELECT per plot (and per species slot).
+		columns that the form doesn't have are skipped (survey_trees) or left empty (survey_plots).
+		"""
+		for silvsys, table in self.survey_tbl_names.items():
+			if table not in self.tablenames_n_rec_count:
+				self.logger.info("!!!! %s table not found. No %s records in %s and %s."%(table, silvsys, self.trees_tblname, self.plots_tblname))
+				continue
+			fieldnames = self.tablenames_n_rec_count[table][0]
+
+			for p in range(1, self.num_of_plots + 1):
+				for s in range(1, self.num_of_spc_slots + 1):
+					name_col = 'Species%sSpeciesNamePlot%s'%(s, p)
+					count_col = 'Species%sNumberofTreesPlot%s'%(s, p)
+					if name_col not in fieldnames or count_col not in fieldnames:
+						continue
+					if silvsys == 'SH':
+						plot_area = '8' if s <= 3 else '16'
+					else:
+						plot_area = "CASE WHEN PlotSize = '4 sqm' THEN 4 ELSE 8 END" if 'PlotSize' in fieldnames else '8'
+
+					# species code is the first 2 or 3 letters of the species name. eg. 'Bf (fir, balsam)' -> 'BF' (same as analysis.summarize_clusters)
+					self.cur.execute("""INSERT INTO %s (silvsys, cluster_uid, plot, slot, plot_area, species_code, species_name, count)
+						SELECT ?, %s, ?, ?, %s, UPPER(TRIM(SUBSTR(%s || ' ', 1, 3))), %s, CAST(IFNULL(NULLIF(%s, ''), 0) AS INTEGER)
+						FROM %s WHERE LENGTH(%s) >= 2"""%(self.trees_tblname, self.unique_id_field, plot_area, name_col, name_col, count_col, table, name_col),
+						(silvsys, p, s))
+
+				plot_cols = ['%s%s'%(col, p) if '%s%s'%(col, p) in fieldnames else 'NULL' for col in ['UnoccupiedPlot', 'UnoccupiedreasonPlot', 'CommentsPlot', 'PhotosPlot']]
+				self.cur.execute("""INSERT INTO %s (silvsys, cluster_uid, plot, unoccupied, unoccupied_reason, comments, photos)
+					SELECT ?, %s, ?, %s FROM %s"""%(self.plots_tblname, self.unique_id_field, ', '.join(plot_cols), table), (silvsys, p))
+
+		# indexes go in after the inserts, it's faster that way
+		self.cur.execute("CREATE INDEX idx_%s_cluster ON %s (silvsys, cluster_uid, plot)"%(self.trees_tblname, self.trees_tblname))
+		self.cur.execute("CREATE INDEX idx_%s_species ON %s (species_code)"%(self.trees_tblname, self.trees_tblname))
+
+		self.cur.execute("""UPDATE %s SET num_trees = (SELECT IFNULL(SUM(t.count), 0) FROM %s t
+			WHERE t.silvsys = %s.silvsys AND t.cluster_uid = %s.cluster_uid AND t.plot = %s.plot)
+			"""%(self.plots_tblname, self.trees_tblname, self.plots_tblname, self.plots_tblname, self.plots_tblname))
+
+
+	def update_tablename_dict(self):
+		"""
+		updates self.tablenames_n_rec_count (list of attributes and records.)
+		"""
+		for tblname in [self.trees_tblname, self.plots_tblname]:
+			attr_names = [row[1] for row in self.cur.execute("PRAGMA table_info(%s)"%tblname)]
+			rec_count = self.cur.execute("SELECT COUNT(*) FROM %s"%tblname).fetchone()[0]
+			self.tablenames_n_rec_count[tblname] = [attr_names, rec_count]
+			self.logger.info("%s records in %s"%(rec_count, tblname))
+
+
+
+	def run_all(self):
+		# isolation_level = None lets us put everything in one transaction
+		self.con = sqlite3.connect(self.db_filepath, isolation_level = None)
+		self.cur = self.con.cursor()
+		self.cur.execute("BEGIN")
+		self.create_tables()
+		self.fill_tables()
+		self.cur.execute("COMMIT")
+		self.update_tablename_dict()
+		self.con.close()
+
+
+# testing
+if __name__ == '__main__':
+
+	import log
+	import os
+	logfile = os.path.basename(__file__) + '_deleteMeLater.txt'
+	debug = True
+	logger = log.logger(logfile, debug)
+	logger.info('Testing %s              ############################'%os.path.basename(__file__))
+
+	config_file = r'C:\DanielK_Workspace\RAP\script2022\RAP.cfg'
+	cfg_dict = common_functions.cfg_to_dict(config_file)
+	db_filepath = r'C:\DanielK_Workspace\RAP_Outputs\2023run\sqlite\RAP_230110110426.sqlite'
+	con = sqlite3.connect(db_filepath)
+	tablenames_n_rec_count = {}
+	for table in ['Clearcut_Survey_v2022', 'Shelterwood_Survey_v2022']:
+		fieldnames = [row[1] for row in con.execute("PRAGMA table_info(%s)"%table)]
+		tablenames_n_rec_count[table] = [fieldnames, con.execute("SELECT COUNT(*) FROM %s"%table).fetchone()[0]]
+	con.close()
+
+	test = Long_format(cfg_dict, db_filepath, tablenames_n_rec_count, logger)
+	test.run_all()
@@ -1,17 +1,201 @@
 # the purpose of this script is to add a new table to the existing sqlite database
 # The new table will be created from the input shapefile that defines the boundary and other parameters.
 # It will also check if the project id field contains unique project ids - throws an error if not all unique.
-
-import os, sqlite3
-from osgeo import ogr
+# The geometry of each project polygon is kept as a WKB blob (shp2sqlite_geom_fieldname) so it can be read back from the sqlite database.
+# The field names, record count and spatial reference of the shapefile go into a one-row table next to it (eg. projects_shp_info).
+# The bounding box of each polygon goes into an sqlite R*Tree (eg. projects_shp_rtree: id = rowid of projects_shp, minx, maxx, miny, maxy).
+# determine_project_id joins it to the cluster points table (eg. cluster_points: silvsys, unique_id, lon, lat, x, y - all REAL coordinates)
+# to find the candidate projects of each cluster, and the same join can be used for ad-hoc queries. eg. clusters in the box of project X:
+#	SELECT c.silvsys, c.unique_id FROM cluster_points c, projects_shp_rtree r, projects_shp p WHERE p.PROJECTID = 'X' AND r.id = p.rowid
+#	AND c.x BETWEEN r.minx AND r.maxx AND c.y BETWEEN r.miny AND r.maxy
+# if reuse_unchanged_shp = True, these tables are kept in the cache folder and copied from there as long as the shapefile hasn't changed.
+#
+# There are two ways of reading the shapefile (see shp_reader in the config file):
+# 'ogr': GDAL/OGR (osgeo). This reads any shapefile but importing osgeo is slow.
+# 'numpy': reads the .shp, .shx and .dbf files directly (memory-mapped) with the functions below. Only polygon shapefiles can be read this way.
+#		if this doesn't work for the shapefile (or osgeo is not installed), the other one is used.
+# reference: https://www.esri.com/content/dam/esrisites/sitecore-archive/Files/Pdfs/library/whitepapers/pdfs/shapefile.pdf
+#			 https://www.clicketyclick.dk/databases/xbase/format/dbf.html
+
+import os, json, mmap, struct, codecs, sqlite3
+import numpy as np
+try:
+	from osgeo import ogr
+except ImportError:
+	ogr = None
 
 # importing custom modules
 if __name__ == '__main__':
-	import common_functions
+	import common_functions, csv2sqlite
 else:
-	from modules import common_functions
+	from modules import common_functions, csv2sqlite
 	
 
+
+def map_file(filepath):
+	"""
+	memory-maps a file (read-only). The file doesn't need to stay open once it's mapped.
+	"""
+	with open(filepath, 'rb') as f:
+		return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+
+def read_shp_polygons(shp_path, shx_path):
+	"""
+	reads the polygons of a shapefile (Polygon, PolygonZ or PolygonM. Z and M values are ignored).
+	the record offsets come from the .shx file.
+	returns a list with one item per record: a list of rings, or None if the record has no shape.
+	each ring is a numpy array of (x, y) points eg. array([[-81.18, 48.50], [-81.17, 48.51],...]) that points straight into the mapped .shp file (nothing is copied).
+	raises ValueError if the shapefile is not a polygon shapefile.
+	"""
+	shp = map_file(shp_path)
+	shx = map_file(shx_path)
+	file_code, shape_type = struct.unpack('>i', shp[0:4])[0], struct.unpack('<i', shp[32:36])[0]
+	if file_code != 9994:
+		raise ValueError('%s is not a shapefile'%shp_path)
+	if shape_type not in [5, 15, 25]:
+		raise ValueError('%s is not a polygon shapefile (shape type %s)'%(shp_path, shape_type))
+
+	num_records = (len(shx) - 100) // 8
+	offsets = np.frombuffer(shx, dtype = '>i4', count = num_records * 2, offset = 100)[0::2].astype(np.int64) * 2 # offsets are in 16-bit words
+	records = []
+	for offset in offsets:
+		content = offset + 8 # skipping the record header (record number, content length)
+		rec_shape_type = struct.unpack('<i', shp[content:content + 4])[0]
+		if rec_shape_type == 0:
+			records.append(None)
+			continue
+		if rec_shape_type not in [5, 15, 25]:
+			raise ValueError('record at %s of %s is not a polygon (shape type %s)'%(offset, shp_path, rec_shape_type))
+		num_parts, num_points = struct.unpack('<ii', shp[content + 36:content + 44])
+		parts = np.frombuffer(shp, dtype = '<i4', count = num_parts, offset = content + 44)
+		points = np.frombuffer(shp, dtype = '<f8', count = num_points * 2, offset = content + 44 + 4 * num_parts).reshape(-1, 2)
+		ends = list(parts[1:]) + [num_points]
+		records.append([points[start:end] for start, end in zip(parts, ends)])
+	return records
+
+
+def ring_is_clockwise(ring):
+	"""
+	shapefile polygons have clockwise outer rings and counter-clockwise holes.
+	"""
+	x, y = ring[:, 0], ring[:, 1]
+	return np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]) < 0
+
+
+def point_in_ring(x, y, ring):
+	"""
+	even-odd (ray casting) test of one point against one ring.
+	"""
+	x1, y1, x2, y2 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+	crosses = (y1 > y) != (y2 > y)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+	return bool(np.count_nonzero(crosses & (x < x_cross)) % 2)
+
+
+def rings_to_wkb(rings):
+	"""
+	turns the rings of a shapefile record into WKB (little endian). eg. b'\\x01\\x03\\x00\\x00\\x00...'
+	every clockwise ring starts a new polygon and each hole goes to the polygon it lies in (the same way OGR does it),
+	so the result is a Polygon if there's one outer ring, otherwise a MultiPolygon.
+	"""
+	outers = [ring for ring in rings if ring_is_clockwise(ring)]
+	if len(outers) == 0:
+		# wrong orientation everywhere. treat every ring as an outer ring.
+		outers = rings
+	polygons = [[ring] for ring in outers]
+	for ring in rings:
+		if any(ring is outer for outer in outers):
+			continue
+		owner = polygons[-1]
+		for polygon in polygons:
+			if point_in_ring(ring[0, 0], ring[0, 1], polygon[0]):
+				owner = polygon
+				break
+		owner.append(ring)
+
+	def polygon_wkb(polygon):
+		wkb = struct.pack('<BII', 1, 3, len(polygon))
+		for ring in polygon:
+			wkb += struct.pack('<I', len(ring)) + np.ascontiguousarray(ring, dtype = '<f8').tobytes()
+		return wkb
+
+	if len(polygons) == 1:
+		return polygon_wkb(polygons[0])
+	return struct.pack('<BII', 1, 6, len(polygons)) + b''.join(polygon_wkb(polygon) for polygon in polygons)
+
+
+def read_dbf(dbf_path, cpg_path = None):
+	"""
+	reads the attribute table (.dbf) of a shapefile.
+	the values are converted the way OGR does it: N/F fields become int or float (None if blank), D fields become 'YYYY/MM/DD',
+	L fields become 1 or 0, and the text fields are decoded with the code page in the .cpg file (or the language driver of the .dbf) and trimmed.
+	returns [fieldnames, records] eg. [['OBJECTID', 'ProjectID', 'Area_ha',...], [[1, 'TIM-Gil01', 8.41044,...],...]]
+	a deleted record is None in the list, so the records still line up with the shapes in the .shp file.
+	"""
+	dbf = map_file(dbf_path)
+	num_records, header_len, record_len = struct.unpack('<IHH', dbf[4:12])
+
+	encoding = 'latin-1'
+	if dbf[29] in [0x03, 0x57]:
+		encoding = 'cp1252'
+	elif dbf[29] == 0x01:
+		encoding = 'cp437'
+	if cpg_path != None and os.path.isfile(cpg_path):
+		with open(cpg_path) as f:
+			cpg = f.read().strip()
+		cpg = 'cp' + cpg if cpg.isdigit() else cpg
+		try:
+			encoding = codecs.lookup(cpg).name
+		except LookupError:
+			pass
+
+	fields = [] # eg. [['OBJECTID', 'N', 1, 10, 0], ['ProjectID', 'C', 11, 50, 0],...] (name, type, position in the record, length, decimals)
+	pos = 1 # first byte of each record is the deletion flag
+	for start in range(32, header_len - 1, 32):
+		if dbf[start] == 0x0D:
+			break
+		name = dbf[start:start + 11].split(b'\x00')[0].decode(encoding).strip()
+		field_type = chr(dbf[start + 11])
+		length, decimals = dbf[start + 16], dbf[start + 17]
+		fields.append([name, field_type, pos, length, decimals])
+		pos += length
+
+	def convert(raw, field_type, length, decimals):
+		if field_type in ['N', 'F']:
+			value = raw.strip()
+			if value == b'' or value.strip(b'*') == b'':
+				return None
+			if field_type == 'N' and decimals == 0 and length <= 18:
+				try:
+					return int(value)
+				except ValueError:
+					return int(float(value))
+			return float(value)
+		if field_type == 'D':
+			value = raw.strip()
+			if value in [b'', b'00000000']:
+				return None
+			value = value.decode('ascii')
+			return '%s/%s/%s'%(value[0:4], value[4:6], value[6:8])
+		if field_type == 'L':
+			value = raw.strip().upper()
+			return 1 if value in [b'T', b'Y'] else 0 if value in [b'F', b'N'] else None
+		value = raw.decode(encoding, errors = 'replace').rstrip(' \x00')
+		return value if value != '' else None
+
+	records = []
+	for n in range(num_records):
+		record = dbf[header_len + n * record_len:header_len + (n + 1) * record_len]
+		if record[0:1] == b'*':
+			records.append(None)
+			continue
+		records.append([convert(record[pos:pos + length], field_type, length, decimals) for name, field_type, pos, length, decimals in fields])
+	return [[field[0] for field in fields], records]
+
+
+
 class Shp2sqlite:
 	"""
 	Use 'run_all' method to run all the methods at once.
@@ -22,6 +206,12 @@ class Shp2sqlite:
 		self.prj_shpfile = cfg_dict['SHP']['project_shpfile']
 		self.prjID_field = cfg_dict['SHP']['project_id_fieldname']
 		self.new_tablename = cfg_dict['SHP']['shp2sqlite_tablename']
+		self.geom_field = cfg_dict['SHP']['shp2sqlite_geom_fieldname']
+		self.info_tablename = self.new_tablename + '_info'
+		self.rtree_tablename = self.new_tablename + '_rtree'
+		self.reuse_unchanged_shp = eval(cfg_dict['SHP']['reuse_unchanged_shp'])
+		self.shp_reader = cfg_dict['SHP']['shp_reader'].strip().lower() # 'ogr' or 'numpy'
+		self.cache_folderpath = common_functions.get_cache_folderpath(cfg_dict) if self.reuse_unchanged_shp else None
 
 		# other static and non-static variables that brought into this class:
 		self.db_filepath = db_filepath
@@ -32,7 +222,14 @@ class Shp2sqlite:
 		self.rec_count = 0
 		self.attr_names = [] # eg. ['OBJECTID', 'ProjectID', 'Area_ha', 'MNRF_AsMet', 'PlotSize_m', 'YRDEP',...]
 		self.shp_in_dict = [] # eg. [{'OBJECTID': 1, 'ProjectID': 'BuildingSouth', 'Area_ha': 8.41044}, {'OBJECTID': 2, 'ProjectID': 'BuildingNorth', 'Area_ha': 2.322}..]
+		self.shp_geoms = [] # WKB of each record in the same order as shp_in_dict. eg. [b'\x01\x03\x00\x00\x00...', ...]
+		self.shp_envelopes = [] # bounding box of each record eg. [[-81.19, -81.17, 48.49, 48.51], None,...] (minx, maxx, miny, maxy)
 		self.duplicates = None # this will be a list of duplicate ProjectID values if any duplicates present.
+		self.spatial_ref = '' # spatial reference of the shapefile in WKT
+		self.is_geographic = False
+		self.cache_db = None
+		self.shp_fingerprints = {} # eg. {'.shp': [1027904, 1678901234.5, '9f86d081...'], '.shx': [...], '.dbf': [...], '.prj': [...]}
+		self.shp_settings = repr([self.new_tablename, self.geom_field])
 
 
 		self.logger.info('\n')
@@ -40,10 +237,67 @@ class Shp2sqlite:
 
 
 	def read_shpfile(self):
-		"""this module turns the shapefile into a list of dictionaries.
+		"""this module turns the shapefile into a list of dictionaries (and a list of WKB geometries).
+		uses read_shpfile_numpy or read_shpfile_ogr depending on shp_reader.
 		"""
-
 		self.logger.debug('Running shp2sqlite.read_shpfile()')
+		if self.shp_reader == 'numpy' or ogr == None:
+			try:
+				self.read_shpfile_numpy()
+				return
+			except (ValueError, OSError, struct.error) as e:
+				if ogr == None:
+					raise
+				self.logger.info("!!!! Could not read %s without OGR (%s). Reading it with OGR instead."%(os.path.basename(self.prj_shpfile), e))
+		self.read_shpfile_ogr()
+
+
+	def read_shpfile_numpy(self):
+		"""reads the shapefile without GDAL/OGR (see read_shp_polygons and read_dbf).
+		the result is the same as read_shpfile_ogr.
+		"""
+		self.logger.debug('Reading %s with the numpy reader'%self.prj_shpfile)
+		base_path = os.path.splitext(self.prj_shpfile)[0]
+		polygons = read_shp_polygons(base_path + '.shp', base_path + '.shx')
+		fieldnames, records = read_dbf(base_path + '.dbf', base_path + '.cpg')
+		if len(polygons) != len(records):
+			raise ValueError('.shp has %s records but .dbf has %s records'%(len(polygons), len(records)))
+
+		spatial_ref, is_geographic = '', False
+		if os.path.isfile(base_path + '.prj'):
+			with open(base_path + '.prj') as f:
+				spatial_ref = f.read().strip()
+			is_geographic = spatial_ref.upper().startswith('GEOGCS') or spatial_ref.upper().startswith('GEOGCRS')
+
+		self.attr_names = [name.upper() for name in fieldnames]
+		# deleted records are skipped (same as OGR).
+		# in shp_in_dict, None objects must be converted to an empty string - so it can be entered into the sqlite
+		self.shp_in_dict = [{k:(str(v) if v != None else '') for k, v in zip(self.attr_names, record)} for record in records if record != None]
+		self.shp_geoms = [rings_to_wkb(rings) if rings else None for rings, record in zip(polygons, records) if record != None]
+		self.shp_envelopes = []
+		for rings, record in zip(polygons, records):
+			if record == None:
+				continue
+			if rings:
+				points = np.concatenate(rings)
+				self.shp_envelopes.append([points[:, 0].min(), points[:, 0].max(), points[:, 1].min(), points[:, 1].max()])
+			else:
+				self.shp_envelopes.append(None)
+		self.spatial_ref, self.is_geographic = spatial_ref, is_geographic
+
+		# get total number of records
+		self.rec_count = len(self.shp_in_dict)
+		if self.rec_count == 0:
+			self.logger.info("!!! Your shapefile has zero record !!!")
+
+		self.logger.debug('Completed running shp2sqlite.read_shpfile_numpy()')
+		self.logger.debug('First record in self.shp_in_dict: %s'%self.shp_in_dict[0])
+
+
+	def read_shpfile_ogr(self):
+		"""reads the shapefile with OGR.
+		the layer is read once, from the first feature to the last.
+		"""
 		driver = ogr.GetDriverByName('ESRI Shapefile')
 		dataSource = driver.Open(self.prj_shpfile,0) # 0 means read-only. 1 means writeable.
 		
@@ -52,10 +306,10 @@ class Shp2sqlite:
 		    self.logger.info('Could not open %s' % (self.prj_shpfile))		
 
 		layer = dataSource.GetLayer()
-		# get total number of records
-		self.rec_count = layer.GetFeatureCount()
-		if self.rec_count == 0:
-			self.logger.info("!!! Your shapefile has zero record !!!")
+		spatialRef = layer.GetSpatialRef()
+		if spatialRef is not None:
+			self.spatial_ref = spatialRef.ExportToWkt()
+			self.is_geographic = bool(spatialRef.IsGeographic())
 
 		# get a list of attribute names
 		layer_def = layer.GetLayerDefn()
@@ -64,16 +318,22 @@ class Shp2sqlite:
 			# self.attr_names.append(field_def.name)
 			self.attr_names.append(field_def.name.upper())
 
-		# grab each record in dictionary form
-		temp_shp_in_dict = []
-		for n in range(self.rec_count):
-			temp_shp_in_dict.append(layer.GetFeature(n).items()) #eg. {'OBJECTID': 3, 'ProjectID': 'TheTrail', 'Area_ha': 29.7181,..}
-
-		# python's dictionary is case sensitive - convert all the keys (fieldnames) to uppercase
-		# in shp_in_dict, None objects must be converted to an empty string - so it can be entered into the sqlite
-		for row in temp_shp_in_dict:
+		# grab each record in dictionary form along with its geometry
+		layer.ResetReading()
+		for feature in layer:
+			row = feature.items() #eg. {'OBJECTID': 3, 'ProjectID': 'TheTrail', 'Area_ha': 29.7181,..}
+			# python's dictionary is case sensitive - convert all the keys (fieldnames) to uppercase
+			# in shp_in_dict, None objects must be converted to an empty string - so it can be entered into the sqlite
 			new_row = {k.upper():(str(v) if v != None else '') for k, v in row.items()}
 			self.shp_in_dict.append(new_row) #eg. {'OBJECTID': 3, 'PROJECTID': 'THETRAIL', 'AREA_HA': 29.7181,..}
+			geom = feature.GetGeometryRef()
+			self.shp_geoms.append(bytes(geom.ExportToWkb()) if geom is not None else None)
+			self.shp_envelopes.append(list(geom.GetEnvelope()) if geom is not None else None) # (minx, maxx, miny, maxy)
+
+		# get total number of records
+		self.rec_count = len(self.shp_in_dict)
+		if self.rec_count == 0:
+			self.logger.info("!!! Your shapefile has zero record !!!")
 
 		self.logger.debug('Completed running shp2sqlite.read_shpfile()')
 		self.logger.debug('First record in self.shp_in_dict: %s'%self.shp_in_dict[0])
@@ -128,11 +388,127 @@ class Shp2sqlite:
 
 	def to_sqlite(self):
 		"""
-		create a new table in the sqlite database and populate it with self.shp_in_dict that we made
-		in read_shpfile module above.
+		create a new table in the sqlite database and populate it with self.shp_in_dict and self.shp_geoms that we made
+		in read_shpfile module above. all the records go in with one executemany in one transaction.
+		eg. CREATE TABLE projects_shp (OBJECTID,PROJECTID,AREA_HA,...,SHAPE_AREA,GEOM_WKB BLOB)
 		"""
 		self.logger.debug('Running shp2sqlite.to_sqlite()')
-		common_functions.dict_lst_to_sqlite(self.shp_in_dict, self.db_filepath, self.new_tablename, self.logger)
+		if self.rec_count < 1:
+			err_msg = '!!!! %s is empty!!!!!'%self.new_tablename
+			self.logger.info(err_msg)
+			raise Exception(err_msg)
+
+		con = sqlite3.connect(self.db_filepath, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("BEGIN")
+		cur.execute("DROP TABLE IF EXISTS %s"%self.new_tablename)
+		create_t_sql = "CREATE TABLE %s (%s,%s BLOB)"%(self.new_tablename, ','.join(self.attr_names), self.geom_field)
+		self.logger.info(create_t_sql)
+		cur.execute(create_t_sql)
+		insert_sql = "INSERT INTO %s VALUES (%s)"%(self.new_tablename, ','.join(['?']*(len(self.attr_names) + 1)))
+		cur.executemany(insert_sql, ([row[f] for f in self.attr_names] + [geom] for row, geom in zip(self.shp_in_dict, self.shp_geoms)))
+
+		# eg. projects_shp_info: shpfile = 'C:\...\RAP_2023_03.shp', attr_names = '["OBJECTID", "PROJECTID",...]', rec_count = 240, spatial_ref = 'GEOGCS["GCS_WGS_1984",...', is_geographic = 1
+		cur.execute("DROP TABLE IF EXISTS %s"%self.info_tablename)
+		cur.execute("CREATE TABLE %s (shpfile TEXT, attr_names TEXT, rec_count INTEGER, spatial_ref TEXT, is_geographic INTEGER)"%self.info_tablename)
+		cur.execute("INSERT INTO %s VALUES (?,?,?,?,?)"%self.info_tablename,
+			(self.prj_shpfile, json.dumps(self.attr_names), self.rec_count, self.spatial_ref, int(self.is_geographic)))
+
+		# R*Tree of the bounding boxes. the id is the rowid of the record in the shp2sqlite table (1, 2, 3,... in the shapefile's order).
+		cur.execute("DROP TABLE IF EXISTS %s"%self.rtree_tablename)
+		try:
+			cur.execute("CREATE VIRTUAL TABLE %s USING rtree(id, minx, maxx, miny, maxy)"%self.rtree_tablename)
+			cur.executemany("INSERT INTO %s VALUES (?,?,?,?,?)"%self.rtree_tablename,
+				([n + 1] + [float(v) for v in envelope] for n, envelope in enumerate(self.shp_envelopes) if envelope != None))
+		except sqlite3.OperationalError as e:
+			self.logger.info("!!!! Could not create %s (%s). The sqlite library may not have the R*Tree module."%(self.rtree_tablename, e))
+		cur.execute("COMMIT")
+		con.close()
+		self.logger.info('%s records inserted into %s'%(self.rec_count, self.new_tablename))
+
+
+	def copy_rtree(self, cur, from_db, to_db):
+		"""
+		copies the R*Tree table from one attached database to another (csv2sqlite.copy_table doesn't work on virtual tables).
+		the caller takes care of ATTACH and BEGIN/COMMIT.
+		"""
+		cur.execute("DROP TABLE IF EXISTS %s.%s"%(to_db, self.rtree_tablename))
+		if cur.execute("SELECT COUNT(*) FROM %s.sqlite_master WHERE name = ?"%from_db, (self.rtree_tablename,)).fetchone()[0] > 0:
+			cur.execute("CREATE VIRTUAL TABLE %s.%s USING rtree(id, minx, maxx, miny, maxy)"%(to_db, self.rtree_tablename))
+			cur.execute("INSERT INTO %s.%s SELECT * FROM %s.%s"%(to_db, self.rtree_tablename, from_db, self.rtree_tablename))
+
+
+	def check_shp_cache(self):
+		"""
+		compares the fingerprints (size, modified time and sha256) of the .shp, .shx, .dbf and .prj files with the ones saved in the cache by the last run.
+		returns True if none of them has changed (and the shapefile is the same file with the same settings).
+		"""
+		self.cache_db = os.path.join(self.cache_folderpath, 'shp_cache.sqlite')
+		self.logger.debug("Checking the shapefile against the cache: %s"%self.cache_db)
+		con = sqlite3.connect(self.cache_db, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("CREATE TABLE IF NOT EXISTS shp_fingerprints (shpfile TEXT PRIMARY KEY, fingerprints TEXT, settings TEXT)")
+		cached = cur.execute("SELECT fingerprints, settings FROM shp_fingerprints WHERE shpfile = ?", (self.prj_shpfile,)).fetchone()
+		con.close()
+
+		old_fingerprints = json.loads(cached[0]) if cached != None else {}
+		for ext in ['.shp', '.shx', '.dbf', '.prj']:
+			filepath = os.path.splitext(self.prj_shpfile)[0] + ext
+			if os.path.isfile(filepath):
+				self.shp_fingerprints[ext] = common_functions.file_fingerprint(filepath, old_fingerprints.get(ext))
+			else:
+				self.shp_fingerprints[ext] = None
+
+		if cached == None or cached[1] != self.shp_settings:
+			return False
+		for ext, fingerprint in self.shp_fingerprints.items():
+			old = old_fingerprints.get(ext)
+			if (fingerprint == None) != (old == None):
+				return False
+			if fingerprint != None and (fingerprint[0] != old[0] or fingerprint[2] != old[2]):
+				return False
+		return True
+
+
+	def load_from_cache(self):
+		"""
+		copies the shp2sqlite table and its info table from the cache into the sqlite database.
+		"""
+		self.logger.info("'%s' hasn't changed since the last run. %s is copied from the cache."%(os.path.basename(self.prj_shpfile), self.new_tablename))
+		con = sqlite3.connect(self.db_filepath, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("ATTACH DATABASE ? AS cache", (self.cache_db,))
+		cur.execute("BEGIN")
+		for table in [self.new_tablename, self.info_tablename]:
+			csv2sqlite.copy_table(cur, table, 'cache', 'main', with_extra = False)
+		self.copy_rtree(cur, 'cache', 'main')
+		cur.execute("COMMIT")
+		cur.execute("DETACH DATABASE cache")
+		attr_names, self.rec_count, self.spatial_ref, is_geographic = cur.execute("SELECT attr_names, rec_count, spatial_ref, is_geographic FROM %s"%self.info_tablename).fetchone()
+		self.attr_names = json.loads(attr_names)
+		self.is_geographic = bool(is_geographic)
+		con.close()
+
+
+	def update_shp_cache(self):
+		"""
+		saves the new shp2sqlite table, its info table and the fingerprints of the shapefile in the cache.
+		only a shapefile that passed check_records gets here.
+		"""
+		con = sqlite3.connect(self.db_filepath, isolation_level = None)
+		cur = con.cursor()
+		cur.execute("ATTACH DATABASE ? AS cache", (self.cache_db,))
+		cur.execute("BEGIN")
+		for table in [self.new_tablename, self.info_tablename]:
+			csv2sqlite.copy_table(cur, table, 'main', 'cache', with_extra = False)
+		self.copy_rtree(cur, 'main', 'cache')
+		# only the last shapefile is kept
+		cur.execute("DELETE FROM cache.shp_fingerprints")
+		cur.execute("INSERT INTO cache.shp_fingerprints VALUES (?,?,?)", (self.prj_shpfile, json.dumps(self.shp_fingerprints), self.shp_settings))
+		cur.execute("COMMIT")
+		cur.execute("DETACH DATABASE cache")
+		con.close()
+		self.logger.debug("Saved %s in the cache"%self.new_tablename)
 
 
 	def update_tablename_dict(self):
@@ -144,9 +520,14 @@ class Shp2sqlite:
 
 
 	def run_all(self):
-		self.read_shpfile()
-		self.check_records()
-		self.to_sqlite()
+		if self.reuse_unchanged_shp and self.check_shp_cache():
+			self.load_from_cache()
+		else:
+			self.read_shpfile()
+			self.check_records()
+			self.to_sqlite()
+			if self.reuse_unchanged_shp:
+				self.update_shp_cache()
 		self.update_tablename_dict()
 
 # testing